@@ -0,0 +1,129 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+from fnmatch import fnmatchcase
+
+# Spin counts for "spin total", by day, ISO week, month, quarter or year (and
+# optionally by plate too). Each plate's spin history is parsed into a sorted
+# array of day ordinals (see plate.py), so the date range is cut out of it
+# with two binary searches, the ordinals of all the plates are put into one
+# NumPy array, and the days are turned into bucket numbers and counted in a
+# few vectorised passes, with no per-spin Python objects. Counts by month,
+# quarter or year over the whole history come straight from the plates'
+# rollups (their spins by month, see rollup.py) without parsing the histories
+# at all, for the plates that have good ones.
+
+AGGREGATIONS = ['day', 'week', 'month', 'quarter', 'year']
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal() # Day 0 of datetime64[D]
+
+def bucket_numbers(np, days, aggregate_by):
+    """Map an array of day ordinals to bucket numbers. Later days never get
+    smaller numbers, so a sorted history stays sorted."""
+    if aggregate_by == 'day':
+        return days
+    if aggregate_by == 'week': # The ordinal of the week's Monday (ordinal 1 is a Monday)
+        return days - (days - 1) % 7
+    months = (days - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if aggregate_by == 'month':
+        return months
+    if aggregate_by == 'quarter':
+        return months // 3
+    return months // 12 # year
+
+def term_label(bucket, aggregate_by):
+    bucket = int(bucket)
+    if aggregate_by == 'day':
+        return date.fromordinal(bucket).isoformat()
+    if aggregate_by == 'week':
+        year, week, _ = date.fromordinal(bucket).isocalendar()
+        return "{}-W{:02d}".format(year, week)
+    if aggregate_by == 'month':
+        return "{}-{:02d}".format(1970 + bucket//12, bucket % 12 + 1)
+    if aggregate_by == 'quarter':
+        return "{}-Q{}".format(1970 + bucket//4, bucket % 4 + 1)
+    return str(1970 + bucket)
+
+def matches(p, statuses, code_pattern):
+    if statuses is not None and (p.get('status') or 'Active') not in statuses:
+        return False
+    return code_pattern is None or fnmatchcase(p['code'], code_pattern)
+
+def count_runs(np, owners, buckets, weights):
+    """Sum the weights of each run of equal (owner, bucket) pairs."""
+    run_starts = np.flatnonzero(np.concatenate(([True], (np.diff(buckets) != 0) | (np.diff(owners) != 0))))
+    return owners[run_starts], buckets[run_starts], np.add.reduceat(weights, run_starts)
+
+def count_spins(plates, aggregate_by='month', statuses=None, code_pattern=None, since=None, until=None,
+        by_plate=False):
+    """Count the spins of the plates (a list of plate dicts) in each term.
+    statuses (a list) and code_pattern (a glob, like "p00*") pick out plates,
+    and since and until (dates, both included) limit the spins counted.
+    Returns {term: count} in order of term, or, with by_plate,
+    {code: {term: count}}."""
+    if aggregate_by not in AGGREGATIONS:
+        raise ValueError(f'No idea how to aggregate by {aggregate_by}.')
+    import numpy as np
+    from plate import parse_history
+    from rollup import current_rollup, month_number
+    low = since.toordinal() if since is not None else None
+    high = until.toordinal() if until is not None else None
+    whole_months = aggregate_by in ['month', 'quarter', 'year'] and since is None and until is None
+    codes = []
+    pieces, piece_owners = [], [] # The spins of the plates counted from their histories
+    month_texts, month_starts, month_owners = [], [], [] # and the months of those counted from their rollups
+    for p in plates:
+        if not matches(p, statuses, code_pattern):
+            continue
+        r = current_rollup(p) if whole_months else None
+        if r is not None:
+            if r['count'] > 0:
+                first, counts = r['months'].split(':')
+                month_owners.append(len(codes))
+                month_starts.append(month_number(first))
+                month_texts.append(counts)
+                codes.append(p['code'])
+            continue
+        days = parse_history(p.get('spin_history'))
+        start = bisect_left(days, low) if low is not None else 0
+        end = bisect_right(days, high) if high is not None else len(days)
+        if end > start:
+            piece_owners.append(len(codes))
+            pieces.append(np.frombuffer(days, dtype=np.int32)[start:end])
+            codes.append(p['code'])
+    if len(codes) == 0:
+        return {}
+
+    # Each stream is (plate, bucket, count) triples, sorted by plate and then
+    # by bucket (since each plate's spins and months are in order).
+    streams = []
+    if len(pieces) > 0:
+        buckets = bucket_numbers(np, np.concatenate(pieces).astype(np.int64), aggregate_by)
+        owners = np.repeat(np.array(piece_owners, dtype=np.int64), [len(piece) for piece in pieces])
+        streams.append((owners, buckets, np.ones(len(buckets), dtype=np.int64)))
+    if len(month_texts) > 0: # All the rollups' counts are parsed in one go.
+        counts = np.fromstring(','.join(month_texts), dtype=np.int64, sep=',')
+        lengths = np.array([text.count(',') + 1 for text in month_texts], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        months = np.repeat(np.array(month_starts, dtype=np.int64) - offsets, lengths) + np.arange(len(counts))
+        buckets = months if aggregate_by == 'month' else months // (3 if aggregate_by == 'quarter' else 12)
+        streams.append((np.repeat(np.array(month_owners, dtype=np.int64), lengths), buckets, counts))
+
+    if not by_plate:
+        buckets = np.concatenate([buckets for owners, buckets, counts in streams])
+        first = int(buckets.min())
+        totals = np.bincount(buckets - first, weights=np.concatenate([counts for owners, buckets, counts in streams]))
+        # (One pass, since there are far fewer buckets than spins)
+        return {term_label(first + k, aggregate_by): int(totals[k]) for k in np.flatnonzero(totals)}
+
+    # The (plate, bucket) pairs come in runs that can be counted without a sort.
+    by_owner = {}
+    for owners, buckets, counts in streams:
+        for owner, bucket, count in zip(*[column.tolist() for column in count_runs(np, owners, buckets, counts)]):
+            if count > 0: # (Rollups count the months without spins too.)
+                by_owner.setdefault(owner, []).append((bucket, count))
+    totals = {}
+    for owner in sorted(by_owner):
+        terms = totals.setdefault(codes[owner], {})
+        for bucket, count in by_owner[owner]:
+            terms[term_label(bucket, aggregate_by)] = count
+    return totals
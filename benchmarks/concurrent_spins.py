@@ -0,0 +1,75 @@
+# Stress test for concurrent writers: several processes spin plates in the
+# same rack at the same time (while another process keeps compacting the
+# journal and rewriting the rack), and at the end every one of those spins
+# has to be in the rack.
+
+# Usage:
+# > python benchmarks/concurrent_spins.py --processes 8 --spins 50
+# > python benchmarks/concurrent_spins.py --extension .sqlite
+
+import os, sys, argparse, tempfile, contextlib, io
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import spin
+
+CODES = ['trash', 'dishes', 'laundry']
+
+def make_rack(rack_dir, plates_file):
+    spin.PATH = rack_dir
+    plates = [{'code': code, 'description': 'Do the {}.'.format(code), 'period_in_days': 7,
+        'last_spun': None, 'spin_history': []} for code in CODES]
+    spin.Plates(plates_file=plates_file).store(plates)
+
+def spinner(rack_dir, plates_file, k, spins):
+    spin.PATH = rack_dir
+    plates = spin.Plates(plates_file=plates_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(spins):
+            plates.spin(CODES[(k + i) % len(CODES)])
+
+def compactor(rack_dir, plates_file, rounds):
+    spin.PATH = rack_dir
+    plates = spin.Plates(plates_file=plates_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(rounds):
+            if i % 2 == 0:
+                plates.compact()
+            else: # A full read-modify-write of the rack, which has to retry
+                # whenever a spin lands between the load and the store.
+                while True:
+                    version = plates._store.version()
+                    try:
+                        plates._store.store(plates.load(), expected_version=version)
+                        break
+                    except spin.StaleRackError:
+                        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--spins', type=int, default=50, help='spins per process')
+    parser.add_argument('--extension', default='.json', help='.json or .sqlite')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as rack_dir:
+        plates_file = 'stress' + args.extension
+        make_rack(rack_dir, plates_file)
+        workers = [Process(target=spinner, args=(rack_dir, plates_file, k, args.spins)) for k in range(args.processes)]
+        workers.append(Process(target=compactor, args=(rack_dir, plates_file, args.spins)))
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        spin.PATH = rack_dir
+        plates = spin.Plates(plates_file=plates_file).load()
+        expected = args.processes*args.spins
+        found = sum(len(p['spin_history']) for p in plates)
+        print("{} processes x {} spins: expected {} spins and found {}.".format(args.processes, args.spins, expected, found))
+        if found != expected or any(w.exitcode != 0 for w in workers):
+            print("Spins were lost!")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Microbenchmark for dates.py: how long it takes to turn a rack's spin dates
+# into day ordinals (and last_spun strings into datetimes) with strptime, with
+# date.fromisoformat, with dates.to_ordinals (fromisoformat plus the memo of
+# distinct dates) and with a vectorized numpy.datetime64 conversion, and how
+# that shows up in converting a whole rack to Plate records.
+
+# Usage:
+# > python benchmarks/date_parsing.py
+# > python benchmarks/date_parsing.py --plates 20000 --history 50
+
+import os, sys, argparse
+from datetime import date, datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dates
+from plate import Plate
+from generate_rack import generate_plates
+
+def best_of(runs, function):
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the ways of parsing spin dates.')
+    parser.add_argument('--plates', type=int, default=5000)
+    parser.add_argument('--history', type=int, default=30, help='average spins per plate')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    ps = generate_plates(args.plates, args.history)
+    spin_dates = [d for p in ps for d in p['spin_history']]
+    last_spuns = [p['last_spun'] for p in ps if p['last_spun'] is not None]
+    print("{} spin dates ({} distinct) and {} last_spun times".format(len(spin_dates), len(set(spin_dates)), len(last_spuns)))
+
+    def with_numpy():
+        import numpy as np
+        return (np.array(spin_dates, dtype='datetime64[D]').astype(np.int64) + date(1970, 1, 1).toordinal()).tolist()
+
+    def memoized():
+        dates._ordinals.clear() # Start cold, as a fresh process would.
+        return dates.to_ordinals(spin_dates)
+
+    rows = [
+        ('spin dates: strptime', lambda: [datetime.strptime(s, "%Y-%m-%d").toordinal() for s in spin_dates]),
+        ('spin dates: fromisoformat', lambda: [date.fromisoformat(s).toordinal() for s in spin_dates]),
+        ('spin dates: numpy.datetime64', with_numpy),
+        ('spin dates: dates.to_ordinals', memoized),
+        ('last_spun: strptime', lambda: [datetime.strptime(s, dates.LAST_SPUN_FORMAT) for s in last_spuns]),
+        ('last_spun: dates.parse_last_spun', lambda: [dates.parse_last_spun(s) for s in last_spuns]),
+    ]
+    results = {}
+    for name, function in rows:
+        seconds, result = best_of(args.runs, function)
+        results[name] = (seconds, result)
+    for name, (seconds, result) in results.items():
+        kind = name.split(':')[0]
+        baseline = results[kind + ': strptime'][0]
+        same = result == results[kind + ': strptime'][1]
+        print("{:<34} {:>9.4f} s  {:>6.1f}x{}".format(name, seconds, baseline/seconds, '' if same else '  (DIFFERENT RESULTS)'))
+
+    dates._ordinals.clear()
+    seconds, _ = best_of(args.runs, lambda: [Plate.from_dict(p) for p in ps])
+    print("{:<34} {:>9.4f} s".format("Plate.from_dict, whole rack", seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Generator for synthetic racks, for benchmarking. The plates have the same
+# shape as the ones Plates.load() reads: a code, description, period,
+# last_spun time, spin history and (for some) a status and pauses.
+
+# Usage:
+# > python benchmarks/generate_rack.py 1000 /tmp/plates.json
+# > python benchmarks/generate_rack.py 100000 /tmp/big.sqlite --history 50 --pause-density 0.2
+
+import os, sys, argparse, random
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_PERIODS = [1, 2, 3, 7, 7, 14, 30, 2.5]
+
+def generate_plates(n_plates, history=30, periods=DEFAULT_PERIODS, pause_density=0.1,
+        days_back=900, seed=1, today=None):
+    """Return a list of n_plates random plates. Each plate has between 0 and
+    2*history spins (so history is the average) scattered over the last
+    days_back days, a period drawn from periods, and a pause_density chance
+    of being paused (with an earlier, finished pause too)."""
+    rng = random.Random(seed)
+    today = today or date.today()
+    plates = []
+    for i in range(n_plates):
+        spins = rng.randint(0, 2*history)
+        spin_history = sorted(set((today - timedelta(days=rng.randint(0, days_back))).isoformat() for _ in range(spins)))
+        if len(spin_history) > 0:
+            last_spun = datetime.strptime(spin_history[-1], "%Y-%m-%d") + timedelta(seconds=rng.randint(0, 86399))
+            last_spun = datetime.strftime(last_spun, "%Y-%m-%dT%H:%M:%S.%f")
+        else:
+            last_spun = None
+        plate = {'code': 'p{:06d}'.format(i), 'description': 'Synthetic plate number {}'.format(i),
+            'period_in_days': rng.choice(periods), 'last_spun': last_spun, 'spin_history': spin_history}
+        r = rng.random()
+        if r < pause_density:
+            plate['status'] = 'Paused'
+            paused = today - timedelta(days=rng.randint(1, days_back//3))
+            earlier = paused - timedelta(days=rng.randint(30, days_back//3))
+            plate['pauses'] = [[earlier.isoformat(), (earlier + timedelta(days=rng.randint(1, 29))).isoformat()],
+                [paused.isoformat(), None]]
+        elif r < pause_density + 0.1:
+            plate['status'] = 'Done'
+        plates.append(plate)
+    return plates
+
+def write_rack(plates, filepath):
+    """Write the plates to a rack file (JSON or SQLite, by extension)."""
+    from storage import open_store
+    open_store(filepath).store(plates)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic rack.')
+    parser.add_argument('plates', type=int, help='number of plates')
+    parser.add_argument('filepath', help='rack file to write (.json, .sqlite or .db)')
+    parser.add_argument('--history', type=int, default=30, help='average spins per plate')
+    parser.add_argument('--periods', default=','.join(str(p) for p in DEFAULT_PERIODS),
+        help='comma-separated periods (in days) to draw from')
+    parser.add_argument('--pause-density', type=float, default=0.1, help='fraction of plates that are paused')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    periods = [float(p) if '.' in p else int(p) for p in args.periods.split(',')]
+    plates = generate_plates(args.plates, args.history, periods, args.pause_density, seed=args.seed)
+    write_rack(plates, args.filepath)
+    print("Wrote {} plates to {}.".format(len(plates), args.filepath))
+
+if __name__ == '__main__':
+    main()
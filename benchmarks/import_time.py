@@ -0,0 +1,59 @@
+# Import-time regression check for the spin CLI. Startup dominates the
+# one-shot commands ("spin trash"), so this imports what "python spin.py"
+# imports before it dispatches a command (spin, plus daemon to look for a
+# running "spin serve") in a fresh interpreter with "python -X importtime" a
+# few times, and fails if the best total goes over the threshold. The
+# modules are byte-compiled first, so that compiling them (which takes
+# longer than importing them, and happens on every run where __pycache__
+# can't be written) isn't counted.
+#
+# The threshold leaves about three times what was measured when it was set
+# (around 8 ms for spin and daemon together, best of 5, with Python 3.11).
+
+# Usage:
+# > python benchmarks/import_time.py
+# > python benchmarks/import_time.py --threshold-ms 20 --runs 10
+
+import os, sys, argparse, subprocess, compileall
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_times(modules):
+    """Import modules in a fresh interpreter and return {module name:
+    (self microseconds, cumulative microseconds)} for everything they
+    imported."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(', '.join(modules))],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Check how long the spin CLI takes to import.')
+    parser.add_argument('--threshold-ms', type=float, default=25.0)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modules', default='spin,daemon', help='comma-separated modules to import')
+    args = parser.parse_args()
+    modules = args.modules.split(',')
+
+    compileall.compile_dir(REPO_DIR, maxlevels=0, quiet=1)
+    def total_us(times):
+        return sum(times[module][1] for module in modules)
+    runs = [import_times(modules) for _ in range(args.runs)]
+    best = min(runs, key=total_us)
+    total_ms = total_us(best)/1000.0
+
+    print("Slowest imports in the best of {} runs:".format(args.runs))
+    for name, (self_us, cumulative_us) in sorted(best.items(), key=lambda kv: -kv[1][0])[:10]:
+        print("  {:<40} {:>8.1f} ms self {:>8.1f} ms cumulative".format(name, self_us/1000.0, cumulative_us/1000.0))
+    print("import {}: {:.1f} ms (threshold {:.1f} ms)".format(', '.join(modules), total_ms, args.threshold_ms))
+    if total_ms > args.threshold_ms:
+        print("Import time regression!")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Exercise notify.py against a local stand-in for Slack's webhook: an HTTP
+# server that records every post (and can be told to fail some of them, or
+# to answer 429 like a rate-limited webhook). This sends a burst of messages
+# and checks that every one of them arrives exactly once, in fewer posts than
+# messages, no faster than the rate limit allows, and that send_to_slack
+# itself never waits on the network.
+
+# Usage:
+# > python benchmarks/notify_burst.py --messages 200
+# > python benchmarks/notify_burst.py --failures 0.3 --rate 5
+
+import os, sys, argparse, random, tempfile, threading
+from json import loads
+from time import perf_counter, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import notify
+
+class StandIn(BaseHTTPRequestHandler):
+    posts = [] # (time, data) for each accepted post
+    failures = 0.0
+    rng = random.Random(1)
+
+    def do_POST(self):
+        data = loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if StandIn.rng.random() < StandIn.failures:
+            status = StandIn.rng.choice([429, 500])
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        StandIn.posts.append((perf_counter(), data))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args): # Quiet
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Send a burst of Slack messages to a local stand-in server.')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=3, help='distinct channels among the messages')
+    parser.add_argument('--rate', type=float, default=notify.RATE)
+    parser.add_argument('--burst', type=int, default=notify.BURST)
+    parser.add_argument('--failures', type=float, default=0.0, help='fraction of posts to fail')
+    parser.add_argument('--wait', type=float, default=120, help='seconds to wait for the outbox to empty')
+    args = parser.parse_args()
+    StandIn.failures = args.failures
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/hook'.format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as outbox_dir:
+        notifier = notify.Notifier(url, os.path.join(outbox_dir, 'outbox'), rate=args.rate, burst=args.burst)
+        start = perf_counter()
+        for k in range(args.messages):
+            notifier.send("Message {}".format(k), channel='#channel-{}'.format(k % args.channels))
+            if k % 10 == 9: # Keep messages arriving while the sender works.
+                sleep(0.01)
+        sending = perf_counter() - start
+        emptied = notifier.flush(args.wait)
+        elapsed = perf_counter() - start
+        left = len(notifier.outbox.pending())
+    server.shutdown()
+
+    received = [line for t, data in StandIn.posts for line in data['text'].split('\n')]
+    received = [line.split(' (Sent from')[0] for line in received]
+    expected = ["Message {}".format(k) for k in range(args.messages)]
+    print("{} messages queued in {:.3f} s ({:.2f} ms each)".format(args.messages, sending, 1000*sending/args.messages))
+    print("{} posts received in {:.2f} s ({} messages left in the outbox)".format(len(StandIn.posts), elapsed, left))
+    times = [t for t, data in StandIn.posts]
+    if len(times) > args.burst:
+        # Past the initial burst, the posts can't come faster than the rate.
+        span = times[-1] - times[args.burst - 1]
+        print("Rate after the burst: {:.2f} posts/s (limit {})".format((len(times) - args.burst)/span if span > 0 else float('inf'), args.rate))
+    ok = emptied and sorted(received) == sorted(expected)
+    print("Every message arrived exactly once." if ok else "MISSING OR DUPLICATED MESSAGES")
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
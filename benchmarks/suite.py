@@ -0,0 +1,152 @@
+# Benchmark suite for the Plates commands. For each rack size, this
+# generates a synthetic rack (see generate_rack.py) and times check, all,
+# stats, total, projects and spin on it, reporting the best wall time of a
+# few runs, the peak memory allocated by Python (from tracemalloc, in a
+# separate run) and the functions that took the most time (from cProfile,
+# in another run). The results are saved as JSON, and --compare prints how
+# they changed relative to an earlier results file (e.g., from the
+# previous commit).
+
+# Usage:
+# > python benchmarks/suite.py
+# > python benchmarks/suite.py --scales 10,100,1000,10000,100000 --runs 1
+# > python benchmarks/suite.py --scales 10,1000 --commands check,spin --output before.json
+# > python benchmarks/suite.py --output after.json --compare before.json
+
+import os, sys, io, argparse, random, tempfile, subprocess, platform
+from json import dumps, loads
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+import spin
+from generate_rack import generate_plates, write_rack, DEFAULT_PERIODS
+
+COMMANDS = ['check', 'all', 'stats', 'total', 'projects', 'spin']
+DEFAULT_SCALES = [10, 100, 1000, 10000] # Add 100000 with --scales for the big runs.
+
+def run_command(plates, command, codes, rng):
+    """Run one command (with its output discarded)."""
+    with redirect_stdout(io.StringIO()):
+        if command == 'spin':
+            plates.spin(rng.choice(codes))
+        else:
+            getattr(plates, command)()
+
+def time_runs(plates, command, codes, rng, runs):
+    times = []
+    for _ in range(runs):
+        plates.context = spin.EvalContext()
+        start = perf_counter()
+        run_command(plates, command, codes, rng)
+        times.append(perf_counter() - start)
+    return times
+
+def peak_memory(plates, command, codes, rng):
+    import tracemalloc
+    plates.context = spin.EvalContext()
+    tracemalloc.start()
+    run_command(plates, command, codes, rng)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def top_functions(plates, command, codes, rng, limit):
+    """Profile one run and return the functions with the most cumulative
+    time in it."""
+    import cProfile, pstats
+    plates.context = spin.EvalContext()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    run_command(plates, command, codes, rng)
+    profiler.disable()
+    stats = pstats.Stats(profiler).stats
+    rows = []
+    for (filename, line, name), (primitive_calls, calls, total, cumulative, callers) in stats.items():
+        if filename.startswith(REPO_DIR) and not filename.startswith(BENCHMARKS_DIR): # Only spin's functions
+            rows.append({'function': '{}:{}({})'.format(os.path.relpath(filename, REPO_DIR), line, name),
+                'calls': calls, 'self_seconds': total, 'cumulative_seconds': cumulative})
+    return sorted(rows, key=lambda row: -row['cumulative_seconds'])[:limit]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(args):
+    results = []
+    for n in args.scales:
+        with tempfile.TemporaryDirectory() as rack_dir:
+            spin.PATH = rack_dir
+            plates_file = 'bench' + args.extension
+            start = perf_counter()
+            ps = generate_plates(n, args.history, args.periods, args.pause_density, seed=args.seed)
+            write_rack(ps, os.path.join(rack_dir, plates_file))
+            print("{} plates ({:.1f} s to generate)".format(n, perf_counter() - start))
+            codes = [p['code'] for p in ps]
+            del ps
+            rng = random.Random(args.seed)
+            for command in args.commands:
+                plates = spin.Plates(plates_file=plates_file)
+                times = time_runs(plates, command, codes, rng, args.runs)
+                peak = peak_memory(plates, command, codes, rng)
+                functions = top_functions(plates, command, codes, rng, args.top)
+                results.append({'plates': n, 'command': command, 'wall_seconds': min(times),
+                    'runs': times, 'peak_memory_bytes': peak, 'top_functions': functions})
+                print("  {:<9} {:>9.4f} s  {:>9.1f} MB peak   {}".format(command, min(times), peak/2**20,
+                    ', '.join('{} {:.3f}s'.format(f['function'].split(':')[-1], f['cumulative_seconds']) for f in functions[:3])))
+    return results
+
+def compare(results, baseline):
+    """Print the ratio of each wall time to the same benchmark's in baseline."""
+    before = {(r['plates'], r['command']): r for r in baseline['results']}
+    print("\nCompared to {} ({}):".format(baseline.get('commit'), baseline.get('date')))
+    for r in results:
+        old = before.get((r['plates'], r['command']))
+        if old is not None:
+            ratio = r['wall_seconds']/old['wall_seconds'] if old['wall_seconds'] > 0 else float('inf')
+            flag = '  <-- slower' if ratio > 1.1 else ''
+            print("  {:>7} {:<9} {:>9.4f} s -> {:>9.4f} s  ({:.2f}x){}".format(r['plates'], r['command'],
+                old['wall_seconds'], r['wall_seconds'], ratio, flag))
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the Plates commands on synthetic racks.')
+    parser.add_argument('--scales', default=','.join(str(n) for n in DEFAULT_SCALES), help='comma-separated plate counts')
+    parser.add_argument('--commands', default=','.join(COMMANDS))
+    parser.add_argument('--history', type=int, default=30, help='average spins per plate')
+    parser.add_argument('--periods', default=','.join(str(p) for p in DEFAULT_PERIODS))
+    parser.add_argument('--pause-density', type=float, default=0.1)
+    parser.add_argument('--extension', default='.json', help='.json or .sqlite')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per command (the best one counts)')
+    parser.add_argument('--top', type=int, default=10, help='functions to keep from each profile')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='an earlier results file to compare against')
+    args = parser.parse_args()
+    args.scales = [int(n) for n in args.scales.split(',')]
+    args.commands = args.commands.split(',')
+    args.periods = [float(p) if '.' in p else int(p) for p in args.periods.split(',')]
+    for command in args.commands:
+        if command not in COMMANDS:
+            parser.error("The commands are {}.".format(', '.join(COMMANDS)))
+
+    results = benchmark(args)
+    report = {'commit': git_commit(), 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+        'parameters': {'history': args.history, 'periods': args.periods, 'pause_density': args.pause_density,
+            'extension': args.extension, 'runs': args.runs, 'seed': args.seed},
+        'results': results}
+    with open(args.output, 'w') as f:
+        f.write(dumps(report, indent=4))
+    print("Wrote {}.".format(args.output))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, loads(f.read()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Find the crossover point for --workers: for each rack size, time check, all
+# and stats in one process and with the rack split across N worker processes,
+# and report the smallest rack at which each worker count wins. Below that
+# point, starting the pool and shipping the shards costs more than the
+# parallel work saves. (The workers also parse each distinct spin date only
+# once, so on a rack with long histories they can come out ahead even on one
+# CPU.)
+
+# Usage:
+# > python benchmarks/workers.py
+# > python benchmarks/workers.py --scales 1000,10000,50000 --workers 2,4,8 --commands check
+
+import os, sys, io, argparse, tempfile
+from contextlib import redirect_stdout
+from time import perf_counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+import spin
+from generate_rack import generate_plates, write_rack
+
+COMMANDS = ['check', 'all', 'stats']
+
+def best_time(plates, command, workers, runs):
+    times = []
+    for _ in range(runs):
+        plates.context = spin.EvalContext()
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            getattr(plates, command)(workers=workers)
+        times.append(perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time --workers against a single process.')
+    parser.add_argument('--scales', default='100,1000,5000,20000', help='comma-separated plate counts')
+    parser.add_argument('--workers', default='2,4', help='comma-separated worker counts')
+    parser.add_argument('--commands', default=','.join(COMMANDS))
+    parser.add_argument('--history', type=int, default=30, help='average spins per plate')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    scales = [int(n) for n in args.scales.split(',')]
+    worker_counts = [int(n) for n in args.workers.split(',')]
+    commands = args.commands.split(',')
+    print("({} CPUs)".format(os.cpu_count()))
+
+    crossover = {}
+    print("{:>7}  {:<6} {:>9}".format("Plates", "", "1 worker") + "".join("{:>12}".format("{} workers".format(w)) for w in worker_counts))
+    for n in scales:
+        with tempfile.TemporaryDirectory() as rack_dir:
+            spin.PATH = rack_dir
+            write_rack(generate_plates(n, args.history, seed=args.seed), os.path.join(rack_dir, 'bench.json'))
+            plates = spin.Plates(plates_file='bench.json')
+            for command in commands:
+                single = best_time(plates, command, 1, args.runs)
+                row = "{:>7}  {:<6} {:>9.3f}".format(n, command, single)
+                for w in worker_counts:
+                    t = best_time(plates, command, w, args.runs)
+                    row += "{:>12}".format("{:.3f} {}".format(t, '*' if t < single else ' '))
+                    if t < single:
+                        crossover.setdefault((command, w), n)
+                print(row)
+
+    print("\nSmallest rack where the workers win (* above):")
+    for command in commands:
+        for w in worker_counts:
+            n = crossover.get((command, w))
+            print("  {:<6} {} workers: {}".format(command, w, n if n is not None else "none of the sizes tried"))
+
+if __name__ == '__main__':
+    main()
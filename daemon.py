@@ -0,0 +1,294 @@
+import os, sys, copy
+from json import loads, dumps
+
+# "spin serve" keeps every rack parsed in memory (with its metrics already
+# computed) and listens on a Unix domain socket. When it's running, the spin
+# command just forwards its arguments to it and prints what comes back, so
+# scripts that run spin over and over skip the interpreter's imports, the
+# JSON parse and the metric calculations. Writes still go through the rack's
+# store (with its locking), so they're persisted as usual. If there's no
+# daemon, spin runs the command itself.
+
+def socket_path(rack_dir):
+    return os.environ.get('SPIN_SOCKET', os.path.join(rack_dir, '.spin.sock'))
+
+class NeedsTerminal(Exception):
+    """Raised in the daemon when a command wants to prompt the user, so that
+    the client can run that command itself."""
+    pass
+
+def needs_terminal(input_field):
+    raise NeedsTerminal(input_field)
+
+def file_signature(filepath):
+    try:
+        s = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (s.st_ino, s.st_mtime_ns, s.st_size)
+
+class WarmStore(object):
+    """Wraps a rack's store, keeping the parsed plates in memory for as long as
+    nothing changes the rack on disk. Reads are served from memory (load()
+    hands out shallow copies, since check writes its results onto the plates),
+    and writes go through to the store and are then applied in memory too.
+    A write replaces the dicts of the plates it changes rather than changing
+    them in place, so a dict that is still in the list is still the plate it
+    was when it was converted to a Plate record."""
+
+    def __init__(self, store, filepath):
+        self._store = store
+        self._filepath = filepath
+        self._plates = None
+        self._signature = None
+        self._records = None # (plate list, its dicts as converted, their Plates)
+
+    def signature(self):
+        return (file_signature(self._filepath), file_signature(self._filepath + '.journal'), self._store.version())
+
+    def plates(self):
+        signature = self.signature() # Taken before loading, so a change that
+        # lands during the load just means another load next time.
+        if self._plates is None or signature != self._signature:
+            self._plates = self._store.load()
+            self._signature = signature
+        return self._plates
+
+    def load(self):
+        return [dict(p) for p in self.plates()]
+
+    def plate_records(self):
+        """The plates as Plate records. Plates that haven't changed since the
+        last call keep their records (and so their metrics, in WarmMetrics)."""
+        from plate import Plate
+        plates = self.plates()
+        if self._records is not None and self._records[0] is plates and len(self._records[1]) == len(plates):
+            _, dicts, records = self._records
+            for k in [k for k in range(len(plates)) if plates[k] is not dicts[k]]:
+                dicts[k], records[k] = plates[k], Plate.from_dict(plates[k])
+        else: # Loaded afresh (after some other process wrote, say), so match
+            # the plates up by code, keeping the records of the unchanged ones.
+            previous = {} if self._records is None else {p['code']: (p, plate)
+                for p, plate in zip(self._records[1], self._records[2])}
+            dicts, records = list(plates), []
+            for p in plates:
+                entry = previous.get(p['code'])
+                records.append(entry[1] if entry is not None and entry[0] == p else Plate.from_dict(p))
+            self._records = (plates, dicts, records)
+        return list(records)
+
+    def codes(self):
+        return [p['code'] for p in self.plates()]
+
+    def load_plate(self, code):
+        for p in self.plates():
+            if p['code'] == code:
+                return copy.deepcopy(p)
+        return None
+
+    def version(self):
+        return self._store.version()
+
+    def write_through(self, write, update):
+        """Run write() against the store. If the plates in memory were up to
+        date and the write was the only change to the rack (every write bumps
+        the version by one), apply update() to them rather than reloading."""
+        was_fresh = self._plates is not None and self.signature() == self._signature
+        version = self._store.version()
+        result = write()
+        if was_fresh and self._store.version() == version + 1:
+            update(self._plates)
+            self._signature = self.signature()
+        else:
+            self._plates = None
+        return result
+
+    def store(self, plates, expected_version=None):
+        self._plates = None
+        return self._store.store(plates, expected_version)
+
+    def store_plate(self, plate, expected_version=None):
+        from storage import replace_plate
+        def update(plates):
+            replace_plate(plates, copy.deepcopy(plate))
+        return self.write_through(lambda: self._store.store_plate(plate, expected_version), update)
+
+    def record_event(self, event):
+        from storage import apply_journal_event
+        def update(plates):
+            for k, p in enumerate(plates):
+                if p['code'] == event['code']:
+                    plates[k] = copy.deepcopy(p)
+                    apply_journal_event(plates[k], event)
+        return self.write_through(lambda: self._store.record_event(event), update)
+
+    def compact(self):
+        folded = self._store.compact()
+        if self._plates is not None: # Compacting doesn't change any plates.
+            self._signature = self.signature()
+        return folded
+
+class WarmMetrics(object):
+    """Holds the metrics last computed for each of the WarmStore's Plate
+    records in memory (for inspect(), in place of computing them all). A
+    record is only handed out again while its plate is unchanged, so its
+    metrics can be reused on the same day. When none of the records has
+    changed since the last check, the last RackMetrics is copied whole."""
+
+    def __init__(self):
+        self._entries = {} # code -> (Plate, date, metric values)
+        self._last = None # (Plates, date, RackMetrics, indices of the plates that aren't cacheable)
+        self._reused = False
+
+    def fill(self, plates, metrics, today):
+        from operator import is_
+        from plate import METRICS
+        last = self._last
+        self._reused = (last is not None and last[1] == today and len(last[0]) == len(plates)
+            and all(map(is_, plates, last[0])))
+        if self._reused:
+            for field in METRICS:
+                getattr(metrics, field)[:] = getattr(last[2], field)
+            return [(i, None) for i in last[3]]
+        entries = self._entries
+        columns = [getattr(metrics, field) for field in METRICS]
+        dirty = []
+        for i, plate in enumerate(plates):
+            entry = entries.get(plate.code)
+            if entry is not None and entry[0] is plate and entry[1] == today:
+                for column, value in zip(columns, entry[2]):
+                    column[i] = value
+            else:
+                dirty.append((i, None))
+        return dirty
+
+    def update(self, plates, metrics, dirty, today):
+        from plate import METRICS, is_cacheable
+        if self._reused: # Only the plates that can't be cached were recomputed.
+            self._last = (self._last[0], today, metrics, self._last[3])
+            return
+        if len(self._entries) > 0 and len(dirty) < len(plates):
+            codes = set(plate.code for plate in plates)
+            for code in [code for code in self._entries if code not in codes]:
+                del self._entries[code]
+        else:
+            self._entries = {}
+        columns = [getattr(metrics, field) for field in METRICS]
+        uncacheable = []
+        for i, key in dirty:
+            if is_cacheable(plates[i]):
+                self._entries[plates[i].code] = (plates[i], today, tuple(column[i] for column in columns))
+            else:
+                uncacheable.append(i)
+        self._last = (list(plates), today, metrics, uncacheable)
+
+def warm_up(spin, plates):
+    """Load a rack and compute the metrics of all of its plates ahead of the
+    first check."""
+    spin.inspect(plates.load_plates(), plates.warm_metrics, announce=False)
+
+def handle(connection, spin, plates_for):
+    import io, traceback
+    from contextlib import redirect_stdout, redirect_stderr
+    request = loads(connection.makefile('rb').readline())
+    out, err = io.StringIO(), io.StringIO()
+    status = 'ok'
+    cwd = os.getcwd()
+    try:
+        os.chdir(request['cwd']) # So relative paths mean what the client meant.
+        with redirect_stdout(out), redirect_stderr(err):
+            spin.main(request['argv'], plates_for)
+    except NeedsTerminal:
+        status = 'interactive'
+    except SystemExit as e: # fire exits after printing usage errors.
+        status = 'ok' if not e.code else 'error'
+    except Exception:
+        err.write(traceback.format_exc())
+        status = 'error'
+    finally:
+        os.chdir(cwd)
+    response = {'status': status, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+    connection.sendall((dumps(response) + "\n").encode('utf-8'))
+
+def serve(spin):
+    """Run the daemon. spin is the spin module (passed in rather than imported,
+    since it's usually running as __main__)."""
+    import socket
+    path = socket_path(spin.PATH)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print("A spin daemon is already listening on {}.".format(path))
+            return
+        except ConnectionRefusedError: # Left behind by a daemon that died.
+            os.remove(path)
+        finally:
+            probe.close()
+
+    racks = {}
+    def plates_for(plates_file):
+        if plates_file not in racks:
+            plates = spin.Plates(plates_file=plates_file)
+            plates._store = WarmStore(plates._store, str(plates))
+            plates.warm_metrics = WarmMetrics()
+            racks[plates_file] = plates
+        return racks[plates_file]
+
+    for rack in spin.find_all_racks():
+        warm_up(spin, plates_for(spin.rack_file(rack)))
+    spin.prompt_for = needs_terminal
+
+    import signal
+    def stop(signum, frame): # Clean up the socket when killed, too.
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    print("Serving {} racks on {}.".format(len(racks), path))
+    try:
+        while True: # One request at a time, since each one captures stdout.
+            # SIGTERM only gets through while waiting for a connection:
+            # handle() would take its SystemExit for the command's own, so
+            # one that arrives mid-request waits until the request is done.
+            # (If it lands just after accept(), the client runs the command
+            # itself.)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGTERM])
+            connection, _ = server.accept()
+            signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM])
+            with connection:
+                handle(connection, spin, plates_for)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+
+def forward(argv, rack_dir):
+    """Have a running daemon execute the command. Returns False if there's no
+    daemon (or the command needs a terminal), in which case the caller should
+    run the command itself."""
+    path = socket_path(rack_dir)
+    if not os.path.exists(path):
+        return False
+    import socket # (Only when there's a daemon to talk to, since it's slow to import.)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        client.close()
+        return False
+    with client:
+        try:
+            client.sendall((dumps({'argv': argv, 'cwd': os.getcwd()}) + "\n").encode('utf-8'))
+            response = loads(client.makefile('rb').readline())
+        except (ValueError, OSError): # The daemon went away without replying.
+            return False
+    if response['status'] == 'interactive':
+        return False
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    if response['status'] == 'error':
+        sys.exit(1)
+    return True
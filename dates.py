@@ -0,0 +1,64 @@
+from datetime import date, datetime
+
+# The two date formats that racks use: "%Y-%m-%d" for spin dates (and pauses)
+# and "%Y-%m-%dT%H:%M:%S.%f" for last_spun. Both are ISO 8601, so they can be
+# parsed with date.fromisoformat/datetime.fromisoformat, which are many times
+# faster than strptime (no format string to interpret, no locale). And since
+# the spin dates in a rack fall on relatively few distinct days, each distinct
+# spin date is parsed just once and looked up after that. Anything not in
+# exactly the expected shape falls back to strptime, which accepts (and
+# rejects) the same strings as before.
+
+SPIN_DATE_FORMAT = "%Y-%m-%d"
+LAST_SPUN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+_ordinals = {} # spin date string -> day ordinal
+
+def is_iso_date(s):
+    # (fromisoformat also takes other ISO forms, like "2024-W01-1".)
+    return len(s) == 10 and s[4] == '-' and s[7] == '-'
+
+def parse_date(s):
+    """A "%Y-%m-%d" string as a date."""
+    if is_iso_date(s):
+        return date.fromisoformat(s)
+    return datetime.strptime(s, SPIN_DATE_FORMAT).date()
+
+def to_ordinal(s):
+    """A "%Y-%m-%d" string as a day ordinal (memoized)."""
+    ordinal = _ordinals.get(s)
+    if ordinal is None:
+        ordinal = _ordinals[s] = parse_date(s).toordinal()
+    return ordinal
+
+def to_ordinals(strings):
+    get = _ordinals.get # The lookups are the whole loop, so skip the call
+    # to to_ordinal() for the dates that have been seen before.
+    return [get(s) or to_ordinal(s) for s in strings]
+
+def parse_day(s):
+    """A "%Y-%m-%d" string as a datetime (at midnight)."""
+    return datetime.fromordinal(to_ordinal(s))
+
+def parse_time(s):
+    """A "%Y-%m-%d" string (as midnight) or an ISO 8601 date and time (like
+    "2024-03-01T08:30") as a datetime."""
+    if is_iso_date(s):
+        return parse_day(s)
+    dt = datetime.fromisoformat(s)
+    if dt.tzinfo is not None: # The rack's times are all local.
+        raise ValueError("{} has a time zone.".format(s))
+    return dt
+
+def parse_last_spun(s):
+    """A LAST_SPUN_FORMAT string as a datetime."""
+    if len(s) == 26 and s[10] == 'T' and s[19] == '.':
+        return datetime.fromisoformat(s)
+    return datetime.strptime(s, LAST_SPUN_FORMAT)
+
+def format_day(dt):
+    """A date or datetime as a "%Y-%m-%d" string."""
+    return dt.isoformat()[:10]
+
+def format_last_spun(dt):
+    return dt.isoformat(timespec='microseconds')
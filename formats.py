@@ -0,0 +1,126 @@
+import os, sys
+from json import dumps
+
+# Machine-readable output for the reports (check, all, stats, total and
+# projects), picked with --format. The records are written one at a time as
+# they're produced, so nothing has to parse the text tables, and a big rack's
+# report is never built up in memory as one string. (And going the other way,
+# the spin events that "spin import" reads.)
+
+FORMATS = ['table', 'json', 'jsonl', 'csv', 'arrow']
+ARROW_BATCH_SIZE = 4096
+
+def is_format(format):
+    if format in FORMATS:
+        return True
+    print("The formats are {}.".format(', '.join(FORMATS)), file=sys.stderr)
+    return False
+
+def write_json(records, out):
+    # A JSON array, written record by record
+    out.write('[')
+    for k, record in enumerate(records):
+        out.write((',\n' if k > 0 else '\n') + dumps(record))
+    out.write('\n]\n')
+
+def write_jsonl(records, out):
+    for record in records:
+        out.write(dumps(record) + '\n')
+
+def write_csv(records, fields, out):
+    import csv
+    writer = csv.DictWriter(out, fieldnames=fields, lineterminator='\n')
+    writer.writeheader()
+    for record in records:
+        # Lists (like spins_by_cycle) go into a single cell as JSON.
+        writer.writerow({field: dumps(value) if isinstance(value, list) else value
+            for field, value in record.items()})
+
+# The Arrow type of each field in the reports (anything else is a string)
+ARROW_TYPES = {'cycles_late': 'float64', 'period_in_days': 'float64', 'angular_momentum': 'float64',
+    'streak': 'int64', 'average_spins': 'float64', 'spins_by_cycle': 'list<int64>',
+    'total_spins': 'int64', 'spins_in_last_2_cycles': 'int64', 'effective_period': 'float64',
+    'spins': 'int64', 'duration_weeks': 'int64'}
+
+def arrow_schema(pa, fields):
+    types = {'float64': pa.float64(), 'int64': pa.int64(), 'list<int64>': pa.list_(pa.int64())}
+    return pa.schema([(field, types.get(ARROW_TYPES.get(field), pa.string())) for field in fields])
+
+def write_arrow(records, fields):
+    """Write the records to stdout as an Arrow IPC stream, in batches."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("The arrow format needs pyarrow (pip install pyarrow).", file=sys.stderr)
+        return
+    binary_out = getattr(sys.stdout, 'buffer', None)
+    if binary_out is None: # Under "spin serve", stdout is captured as text,
+        # so have the client run the command itself.
+        from daemon import NeedsTerminal
+        raise NeedsTerminal('binary output')
+    schema = arrow_schema(pa, fields)
+    with pa.ipc.new_stream(binary_out, schema) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == ARROW_BATCH_SIZE:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if len(batch) > 0:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    binary_out.flush()
+
+def write_records(records, fields, format, out=None):
+    """Write records (an iterable of dicts with the given fields) to out (by
+    default, stdout) in one of the machine-readable formats."""
+    out = out or sys.stdout
+    try:
+        if format == 'json':
+            write_json(records, out)
+        elif format == 'jsonl':
+            write_jsonl(records, out)
+        elif format == 'csv':
+            write_csv(records, fields, out)
+        elif format == 'arrow':
+            out.flush()
+            write_arrow(records, fields)
+        out.flush()
+    except BrokenPipeError: # The reader (e.g., head) stopped reading, which
+        # is fine. Point stdout at /dev/null so that Python's own flush at exit
+        # doesn't complain too.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+##### SPIN EVENTS #####
+# "spin import" reads spins as CSV rows of code,date (with or without that
+# header) or as JSON Lines of {"code": ..., "date": ...}, where each date is
+# either "%Y-%m-%d" or an ISO 8601 date and time.
+
+EVENT_FORMATS = ['csv', 'jsonl']
+
+def event_format(filepath):
+    return 'jsonl' if os.path.splitext(filepath)[1] in ['.jsonl', '.ndjson'] else 'csv'
+
+def read_events(f, format):
+    """Yield (line number, code, date) for each spin in f. A line that can't
+    be read yields None for its code and date."""
+    if format == 'jsonl':
+        from json import loads
+        for line_number, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            try:
+                event = loads(line)
+                yield line_number, str(event['code']), str(event['date'])
+            except (ValueError, KeyError, TypeError):
+                yield line_number, None, None
+        return
+    import csv
+    for line_number, row in enumerate(csv.reader(f), 1):
+        if len(row) == 0:
+            continue
+        if line_number == 1 and [cell.strip().lower() for cell in row] == ['code', 'date']:
+            continue # The header
+        if len(row) != 2:
+            yield line_number, None, None
+        else:
+            yield line_number, row[0].strip(), row[1].strip()
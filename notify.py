@@ -1,39 +1,241 @@
+import os, re, sys, socket, threading, time, atexit
+from functools import lru_cache
+from json import loads, dumps
+from uuid import uuid4
 from parameters.remote_parameters import webhook_url
 
-def send_to_slack(message,username=None,channel=None,icon=None):
-    """This script sends the given message to a particular channel on
-    Slack, as configured by the webhook_url. Note that this shouldn't 
-    be heavily used (e.g., for reporting every error a script 
-    encounters) as API limits are a consideration. This script IS 
-    suitable for running when a script-terminating exception is caught, 
-    so that you can report the irregular termination of an ETL script."""
-
-    import os, re, json, requests
-    import socket
-    IP_address = socket.gethostbyname(socket.gethostname())
-    hostname = re.sub(".local","",socket.gethostname())
-    name_of_current_script = os.path.basename(__file__)
-
-    caboose = "(Sent from {} running on a computer called {} at {}.)".format(name_of_current_script, hostname, IP_address)
-    # Set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
-    slack_data = {'text': message + " " + caboose}
-    slack_data['username'] = 'nudger'
+# Messages for Slack go into an outbox file (one JSON line each) and are
+# posted by a background thread, so the caller doesn't wait on the network.
+# The sender coalesces the waiting messages that share a username, channel
+# and icon into one post, keeps to Slack's rate limit for incoming webhooks
+# with a token bucket, and only removes messages from the outbox once Slack
+# has taken them. Anything that couldn't be posted (no network, Slack being
+# down) stays in the outbox and is retried, by this process or the next one
+# that sends something. (With "spin serve" running, the daemon's sender
+# keeps retrying in the background.)
+
+OUTBOX_FILE = os.environ.get('SLACK_OUTBOX', os.path.expanduser('~/.slack_outbox'))
+RATE = 1.0 # Posts per second (Slack allows about one per second per webhook)
+BURST = 3 # Posts that can go out back to back after a quiet spell
+TIMEOUT = 10 # Seconds to wait for Slack to answer a post
+MAX_TEXT = 3000 # Characters in one coalesced post
+EXIT_WAIT = 5 # Seconds a finishing process waits for the outbox to empty
+MAX_RETRY_DELAY = 60
+NAME_OF_CURRENT_SCRIPT = os.path.basename(__file__) # (Not looked up in the
+# sender thread, which may still be running while the interpreter shuts down.)
+
+@lru_cache(maxsize=None)
+def caboose():
+    # Looked up once per process, since the hostname doesn't change.
+    hostname = socket.gethostname()
+    try:
+        IP_address = socket.gethostbyname(hostname)
+    except OSError:
+        IP_address = 'an unknown address'
+    return "(Sent from {} running on a computer called {} at {}.)".format(NAME_OF_CURRENT_SCRIPT,
+        re.sub(".local","",hostname), IP_address)
+
+def slack_data(text, username=None, channel=None, icon=None):
+    data = {'text': text + " " + caboose(), 'username': 'nudger'}
     if username is not None:
-        slack_data['username'] = username
-    #To send this as a direct message instead, use the following line. 
-    if channel is not None:
-        slack_data['channel'] = channel
+        data['username'] = username
+    if channel is not None: # (e.g., '@david' for a direct message)
+        data['channel'] = channel
     if icon is not None:
-        slack_data['icon_emoji'] = icon #':coffin:' #':tophat:' # ':satellite_antenna:'
-    response = requests.post(
-        webhook_url, data=json.dumps(slack_data),
-        headers={'Content-Type': 'application/json'}
-    )
-    if response.status_code != 200:
-        raise ValueError(
-            'Request to Slack returned an error %s, the response is:\n%s'
-            % (response.status_code, response.text)
-        )
+        data['icon_emoji'] = icon #':coffin:' #':tophat:' # ':satellite_antenna:'
+    return data
+
+def batches(entries, max_text=MAX_TEXT):
+    """Coalesce outbox entries into posts: (the entries' ids, the post's
+    data), with the messages for the same username, channel and icon joined
+    in the order they were sent."""
+    groups = {}
+    for entry in entries:
+        key = (entry.get('username'), entry.get('channel'), entry.get('icon'))
+        groups.setdefault(key, []).append(entry)
+    for (username, channel, icon), group in groups.items():
+        ids, texts, length = [], [], 0
+        for entry in group:
+            if len(texts) > 0 and length + len(entry['text']) > max_text:
+                yield ids, slack_data('\n'.join(texts), username, channel, icon)
+                ids, texts, length = [], [], 0
+            ids.append(entry['id'])
+            texts.append(entry['text'])
+            length += len(entry['text']) + 1
+        yield ids, slack_data('\n'.join(texts), username, channel, icon)
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def take(self):
+        """Wait until a token is available, and take it."""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens)/self.rate)
+
+class Outbox(object):
+    """The messages waiting to be posted, in a file, under the same kind of
+    fcntl lock as the racks (see storage.locked)."""
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+
+    def __str__(self):
+        return self._filepath
+
+    def add(self, entry):
+        from storage import locked
+        with locked(self._filepath):
+            with open(self._filepath,'a') as f:
+                f.write(dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        if not os.path.exists(self._filepath):
+            return []
+        entries = []
+        with open(self._filepath,'r') as f:
+            for line in f:
+                try:
+                    entries.append(loads(line))
+                except ValueError: # A line cut short by a crash
+                    pass
+        return entries
+
+    def pending(self):
+        from storage import locked
+        with locked(self._filepath, exclusive=False):
+            return self.read()
+
+    def remove(self, ids):
+        from storage import locked
+        ids = set(ids)
+        with locked(self._filepath): # (Other processes may have added messages.)
+            kept = [entry for entry in self.read() if entry['id'] not in ids]
+            with open(self._filepath + '.tmp','w') as f:
+                f.write(''.join(dumps(entry) + "\n" for entry in kept))
+            os.replace(self._filepath + '.tmp', self._filepath)
+
+class Notifier(object):
+    """Posts the messages in an outbox to a Slack webhook from a background
+    thread."""
+
+    def __init__(self, url=webhook_url, outbox_file=OUTBOX_FILE, rate=RATE, burst=BURST, timeout=TIMEOUT):
+        self.url = url
+        self.outbox = Outbox(outbox_file)
+        self.timeout = timeout
+        self._bucket = TokenBucket(rate, burst)
+        self._session = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._lock = threading.Lock()
+        self._sent = 0 # Counts send() calls, so that the sender can tell
+        # whether anything came in while it was draining the outbox.
+        self._retry_delay = 1
+
+    def send(self, message, username=None, channel=None, icon=None):
+        self.outbox.add({'id': uuid4().hex, 'text': message, 'username': username,
+            'channel': channel, 'icon': icon})
+        with self._lock:
+            self._sent += 1
+            self._idle.clear()
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='slack-sender', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def session(self):
+        if self._session is None:
+            import requests # Only a process that actually posts pays for this.
+            self._session = requests.Session() # Keeps the connection to Slack open
+            self._session.headers['Content-Type'] = 'application/json'
+        return self._session
+
+    def run(self):
+        while True:
+            with self._lock:
+                sent = self._sent
+                self._wake.clear()
+            if self.drain():
+                self._retry_delay = 1
+                with self._lock:
+                    if self._sent == sent:
+                        self._idle.set()
+                self._wake.wait()
+            else: # Back off before trying again (unless something new comes in).
+                self._wake.wait(self._retry_delay)
+                self._retry_delay = min(2*self._retry_delay, MAX_RETRY_DELAY)
+
+    def drain(self):
+        """Post everything in the outbox. Returns False if some of it has to
+        wait for a retry."""
+        from storage import locked
+        with locked(str(self.outbox) + '.sender'): # One sender at a time, so
+            # that no message gets posted by two processes.
+            for ids, data in batches(self.outbox.pending()):
+                self._bucket.take()
+                if not self.post(data):
+                    return False
+                self.outbox.remove(ids)
+        return True
+
+    def post(self, data):
+        """Post one batch. Returns False if it should be retried later."""
+        import requests
+        try:
+            response = self.session().post(self.url, data=dumps(data), timeout=self.timeout)
+        except requests.RequestException as e:
+            print("Couldn't reach Slack ({}), so the message will be retried.".format(e), file=sys.stderr)
+            return False
+        if response.status_code == 429 or response.status_code >= 500: # Rate-limited or down
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                self._retry_delay = max(1, min(int(retry_after), MAX_RETRY_DELAY))
+            return False
+        if response.status_code != 200: # Retrying a message Slack rejects won't help.
+            print('Request to Slack returned an error %s, the response is:\n%s'
+                % (response.status_code, response.text), file=sys.stderr)
+        return True
+
+    def flush(self, timeout=EXIT_WAIT):
+        """Wait (for up to timeout seconds) for the outbox to empty. Returns
+        whether it did."""
+        if self._thread is None:
+            return True
+        if not self._idle.wait(timeout):
+            print("Some Slack messages are still in {} and will be retried.".format(self.outbox), file=sys.stderr)
+            return False
+        return True
+
+_notifier = None
+
+def send_to_slack(message,username=None,channel=None,icon=None):
+    """This script sends the given message to a particular channel on
+    Slack, as configured by the webhook_url. The message goes into the
+    outbox and send_to_slack returns right away (see above), so it's fine
+    to call this often: bursts get coalesced and rate-limited. This IS
+    suitable for running when a script-terminating exception is caught,
+    so that you can report the irregular termination of an ETL script
+    (since a finishing process waits briefly for the outbox to empty)."""
+    global _notifier
+    if _notifier is None:
+        _notifier = Notifier()
+    _notifier.send(message, username, channel, icon)
 
 if __name__ == '__main__':
     msg = "No sir, away! A papaya war is on!"
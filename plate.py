@@ -0,0 +1,166 @@
+from array import array
+from bisect import bisect_left
+from datetime import date, timedelta
+from dates import to_ordinals, parse_last_spun, format_last_spun
+
+# Compact records for the plates that check inspects. A rack loads as a list
+# of dicts (that's what's in the JSON), but check only needs a few typed
+# fields of each plate, so the plates are converted to Plate objects (with
+# __slots__, the last_spun time already parsed and the spin history as an
+# array of day ordinals), and the metrics computed from them are kept in
+# separate columns (RackMetrics) rather than being added to each plate.
+
+# The per-plate metrics that inspect() computes from the spin history
+METRICS = ['angular_momentum', 'streak', 'average_spins', 'spins_by_cycle']
+
+def is_cacheable(plate):
+    # Whether the plate's metrics hold for the rest of the day they were
+    # computed on. The spins_by_cycle bins end at the current time, so for
+    # periods that are not a whole number of days, the bins shift during the
+    # day.
+    return timedelta(days=plate.period_in_days) % timedelta(days=1) == timedelta(0)
+
+def parse_history(spin_history):
+    """Parse a spin history (a list of "%Y-%m-%d" strings, or None) into a
+    sorted array of day ordinals. This is done once per plate, and all the
+    metric functions work on the resulting array rather than on the date
+    strings."""
+    if spin_history is None:
+        return array('i')
+    return array('i', sorted(to_ordinals(spin_history)))
+
+def is_canonical(spin_history):
+    # A history of distinct "%Y-%m-%d" dates in order can be rebuilt from the
+    # parsed day ordinals.
+    return (all(len(d) == 10 for d in spin_history)
+        and all(a < b for a, b in zip(spin_history, spin_history[1:])))
+
+_key_orders = {} # Plates with the same fields (in the same order) share one tuple.
+
+class REBUILT(object):
+    """Marks a spin history that to_dict() can rebuild from days. (A class,
+    rather than an instance, so that it survives pickling.)"""
+
+class Plate(object):
+    """One plate of a rack. Plate.from_dict(d).to_dict() == d for any plate
+    dict d, including the order of its keys and any fields that Plate doesn't
+    know about."""
+    __slots__ = ['code', 'description', 'period_in_days', 'last_spun_dt', 'days', 'status',
+        'pauses', 'rollup', '_spin_history', '_keys', '_extra']
+
+    FIELDS = ['code', 'description', 'period_in_days', 'last_spun', 'spin_history', 'status', 'pauses', 'rollup']
+
+    @classmethod
+    def from_dict(cls, d, days=None):
+        """Convert a plate dict. days can give the spin history already
+        parsed (as parse_history() would)."""
+        plate = cls()
+        plate.code = d.get('code')
+        plate.description = d.get('description')
+        plate.period_in_days = d.get('period_in_days')
+        last_spun = d.get('last_spun')
+        plate.last_spun_dt = None if last_spun is None else parse_last_spun(last_spun)
+        spin_history = d.get('spin_history')
+        plate.days = parse_history(spin_history) if days is None else days
+        if spin_history is not None and is_canonical(spin_history):
+            plate._spin_history = REBUILT
+        else: # Unsorted, duplicated, unusually formatted or None
+            plate._spin_history = spin_history
+        plate.status = d.get('status')
+        plate.pauses = d.get('pauses')
+        plate.rollup = d.get('rollup')
+        keys = tuple(d.keys())
+        plate._keys = _key_orders.setdefault(keys, keys)
+        extra = {key: value for key, value in d.items() if key not in Plate.FIELDS}
+        plate._extra = extra if len(extra) > 0 else None
+        return plate
+
+    @property
+    def last_spun(self):
+        if self.last_spun_dt is None:
+            return None
+        return format_last_spun(self.last_spun_dt)
+
+    @property
+    def spin_history(self):
+        if self._spin_history is REBUILT:
+            return [date.fromordinal(d).isoformat() for d in self.days]
+        return self._spin_history
+
+    def is_spinning(self):
+        return self.status is None or self.status == 'Active'
+
+    def to_dict(self):
+        d = {}
+        for key in self._keys:
+            if key in Plate.FIELDS:
+                d[key] = getattr(self, key)
+            else:
+                d[key] = self._extra[key]
+        return d
+
+    def __repr__(self):
+        return "Plate({!r})".format(self.to_dict())
+
+class RackMetrics(object):
+    """The metrics of a list of plates, by column: the streak of plates[i]
+    is metrics.streak[i], and so on."""
+    __slots__ = METRICS
+
+    def __init__(self, n):
+        for field in METRICS:
+            setattr(self, field, [None]*n)
+
+    def assign(self, indices, metrics):
+        """Copy the values of metrics (for some other list of plates) into
+        the rows given by indices."""
+        for field in METRICS:
+            column = getattr(self, field)
+            for i, value in zip(indices, getattr(metrics, field)):
+                column[i] = value
+
+class Wobbler(object):
+    """A row of check's table: a plate, its lateness and (through metrics and
+    index) its metrics, without copying any of them."""
+    __slots__ = ['plate', 'metrics', 'index', 'cycles_late', 'rack']
+
+    def __init__(self, plate, metrics, index, cycles_late, rack=None):
+        self.plate = plate
+        self.metrics = metrics
+        self.index = index
+        self.cycles_late = cycles_late
+        self.rack = rack
+
+    def metric(self, field):
+        return getattr(self.metrics, field)[self.index]
+
+class CodeIndex(object):
+    """The codes of a rack's plates, for resolving the code given on the
+    command line: a dict for exact lookups and a sorted list, searched with
+    bisect, for the codes that start with a given prefix. The prefix is
+    taken literally (not as a regex)."""
+
+    def __init__(self, codes):
+        self.codes = codes # In rack order
+        self._positions = {code: k for k, code in enumerate(codes)} # code -> position in the rack
+        self._sorted = sorted(codes)
+
+    def __contains__(self, code):
+        return code in self._positions
+
+    def starting_with(self, prefix):
+        matches = []
+        for code in self._sorted[bisect_left(self._sorted, prefix):]:
+            if not code.startswith(prefix):
+                break
+            matches.append(code)
+        return matches
+
+    def resolve(self, code):
+        """Return the codes that code could mean: just code itself if there's
+        a plate with exactly that code, and otherwise the codes that start
+        with it."""
+        code = str(code) # (fire turns a code like 123 into an int.)
+        if code in self._positions:
+            return [code]
+        return self.starting_with(code)
@@ -0,0 +1,165 @@
+import os, sys
+from time import perf_counter
+
+# Timing spans for finding out where a spin command spends its time. With
+# "spin --profile <command>" (or SPIN_TRACE=1 in the environment), the
+# functions that spin lists in TRACED are wrapped in span timers for the
+# length of the command, and a summary goes to stderr at the end. Giving an
+# output file ("--profile=check.trace" or SPIN_TRACE=check.trace) also writes
+# a Chrome trace-event file (for chrome://tracing or Perfetto) if it ends in
+# .trace (or .json) and cProfile stats (for pstats or snakeviz) otherwise.
+# (.trace keeps the file from looking like a rack; find_all_racks() passes
+# over JSON files that aren't lists of plates, too.)
+#
+# When profiling is off, nothing is wrapped, and span() hands back one
+# shared do-nothing context manager, so the hooks cost next to nothing.
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._profiler.open_span()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.close_span(self._name)
+        return False
+
+class Profiler(object):
+    """Records a (name, start, duration) event for each span, along with the
+    time spent in spans nested inside it (to get each span's self time)."""
+
+    def __init__(self, output=None):
+        self.output = output
+        self.events = []
+        self._stack = [] # [start, time in child spans] for each open span
+        self._patched = []
+        self._cprofile = None
+        self._start = perf_counter()
+
+    def open_span(self):
+        self._stack.append([perf_counter(), 0.0])
+
+    def close_span(self, name):
+        start, child_time = self._stack.pop()
+        duration = perf_counter() - start
+        if len(self._stack) > 0:
+            self._stack[-1][1] += duration
+        self.events.append((name, start - self._start, duration, duration - child_time, len(self._stack)))
+
+    def wrap(self, owner, attribute, name):
+        from functools import wraps
+        original = owner.__dict__[attribute]
+        @wraps(original) # So fire still sees the method's arguments
+        def timed(*args, **kwargs):
+            with Span(self, name):
+                return original(*args, **kwargs)
+        setattr(owner, attribute, timed)
+        self._patched.append((owner, attribute, original))
+
+    def instrument(self, module, names):
+        """Wrap the named functions and methods. A name is a function or
+        "Class.method" in module, or "other_module:name" for another module."""
+        import importlib
+        for full_name in names:
+            owner = module
+            name = full_name
+            if ':' in full_name:
+                module_name, name = full_name.split(':')
+                owner = importlib.import_module(module_name)
+            *classes, attribute = name.split('.')
+            for c in classes:
+                owner = getattr(owner, c)
+            self.wrap(owner, attribute, full_name)
+
+    def restore(self):
+        for owner, attribute, original in reversed(self._patched):
+            setattr(owner, attribute, original)
+        self._patched = []
+
+    def start_cprofile(self):
+        import cProfile
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def summary(self, total):
+        totals = {}
+        for name, start, duration, self_time, depth in self.events:
+            calls, cumulative, own = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (calls + 1, cumulative + duration, own + self_time)
+        lines = ["{:<36} {:>7} {:>11} {:>11} {:>6}".format("Span", "Calls", "Total (ms)", "Self (ms)", "%")]
+        for name, (calls, cumulative, own) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+            lines.append("{:<36.36} {:>7} {:>11.2f} {:>11.2f} {:>6.1f}".format(name, calls,
+                1000*cumulative, 1000*own, 100*cumulative/total if total > 0 else 0.0))
+        lines.append("{:<36} {:>7} {:>11.2f}".format("(whole command)", "", 1000*total))
+        return '\n'.join(lines)
+
+    def write_trace(self, filepath):
+        from json import dumps
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': 1e6*start, 'dur': 1e6*duration, 'pid': pid, 'tid': 0,
+            'args': {'self_ms': 1000*self_time}} for name, start, duration, self_time, depth in self.events]
+        with open(filepath, 'w') as f:
+            f.write(dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+    def finish(self):
+        total = perf_counter() - self._start
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        self.restore()
+        print("\n" + self.summary(total), file=sys.stderr)
+        if self.output is not None:
+            if is_trace_file(self.output):
+                self.write_trace(self.output)
+                print("Wrote a Chrome trace to {}.".format(self.output), file=sys.stderr)
+            else:
+                self._cprofile.dump_stats(self.output)
+                print("Wrote cProfile stats to {}.".format(self.output), file=sys.stderr)
+
+_profiler = None
+
+def span(name):
+    """A context manager that times its block as a span named name (when
+    profiling is on)."""
+    if _profiler is None:
+        return NULL_SPAN
+    return Span(_profiler, name)
+
+def is_trace_file(filepath):
+    return filepath.endswith('.trace') or filepath.endswith('.json')
+
+def requested(flag_value):
+    """Work out from the --profile flag's value (None if it wasn't given,
+    True if it was given without a file) and SPIN_TRACE whether to profile,
+    and where to write the output. Returns (enabled, output file or None)."""
+    if flag_value is None:
+        flag_value = os.environ.get('SPIN_TRACE')
+        if flag_value in [None, '', '0']:
+            return False, None
+        if flag_value == '1':
+            flag_value = True
+    return True, (None if flag_value is True else flag_value)
+
+def start(module, names, output=None):
+    global _profiler
+    _profiler = Profiler(output)
+    _profiler.instrument(module, names)
+    if output is not None and not is_trace_file(output):
+        _profiler.start_cprofile()
+
+def stop():
+    global _profiler
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        profiler.finish()
@@ -0,0 +1,138 @@
+from math import exp, isclose
+from datetime import date
+from dates import to_ordinal, to_ordinals, is_iso_date
+
+# A summary of each plate's spin history, kept in the plate itself (as its
+# "rollup" field), so that the reports can get at the numbers that only change
+# when the plate is spun without going through the whole history:
+#   count      the number of spins
+#   first      the earliest spin date
+#   last       the latest spin date
+#   months     the number of spins in each month, from the month of the first
+#              spin through the month of the last one, written out as one
+#              string ("2024-05:3,0,1") to keep the rack file compact
+#   momentum   sum(exp(-(last - d)/period)) over the spin dates d, which is
+#              the angular momentum as of the last spin. As of any later day,
+#              it's momentum*exp(-(today - last)/period).
+#   period     the period that momentum was computed with
+#   in_order   whether the history is in order (and in the "%Y-%m-%d" form),
+#              so that it can be searched as it is
+# apply_spin() updates the rollup for each spin (aging the momentum forward to
+# the new spin), and "spin reindex" rebuilds all of them. A rollup whose count
+# and ends don't match the plate's history (after a hand edit of the rack, or
+# when --as-of has cut the history short) is ignored, and the history is used
+# instead, as is its momentum when the plate's period has been edited.
+
+def month_number(s):
+    """The month of a "%Y-%m-%d" (or "%Y-%m") string, counted from 1970-01."""
+    return (int(s[:4]) - 1970)*12 + int(s[5:7]) - 1
+
+def month_name(n):
+    return "{}-{:02d}".format(1970 + n//12, n % 12 + 1)
+
+def decode_months(months):
+    """Split a rollup's months into the number of its first month and the
+    list of counts."""
+    if not months:
+        return None, []
+    first, counts = months.split(':')
+    return month_number(first), [int(count) for count in counts.split(',')]
+
+def encode_months(first, counts):
+    if len(counts) == 0:
+        return ""
+    return "{}:{}".format(month_name(first), ','.join(map(str, counts)))
+
+def build_rollup(spin_history, period):
+    """Summarize a spin history (a list of "%Y-%m-%d" strings, or None)."""
+    spin_history = spin_history or []
+    days = sorted(to_ordinals(spin_history))
+    r = {'count': len(days), 'first': None, 'last': None, 'months': "", 'momentum': 0.0,
+        'period': period, 'in_order': all(is_iso_date(s) for s in spin_history)
+            and all(a <= b for a, b in zip(spin_history, spin_history[1:]))}
+    if len(days) > 0:
+        r['first'] = date.fromordinal(days[0]).isoformat()
+        r['last'] = date.fromordinal(days[-1]).isoformat()
+        first = month_number(r['first'])
+        counts = [0]*(month_number(r['last']) - first + 1)
+        for d in days:
+            day = date.fromordinal(d)
+            counts[(day.year - 1970)*12 + day.month - 1 - first] += 1
+        r['months'] = encode_months(first, counts)
+        if period > 0:
+            r['momentum'] = sum(exp(-(days[-1] - d)/period) for d in days)
+    return r
+
+def with_spin(r, date_spun):
+    """Return rollup r updated for one more spin (on date_spun, a "%Y-%m-%d"
+    string) added to the end of the history. (r itself is left alone, since
+    the plate dicts that "spin serve" hands out share it.)"""
+    r = dict(r)
+    r['count'] += 1
+    first, counts = decode_months(r['months'])
+    month = month_number(date_spun)
+    if len(counts) == 0:
+        first, counts = month, [0]
+    elif month < first:
+        first, counts = month, [0]*(first - month) + counts
+    elif month >= first + len(counts):
+        counts += [0]*(month - first - len(counts) + 1)
+    counts[month - first] += 1
+    r['months'] = encode_months(first, counts)
+    r['in_order'] = r['in_order'] and (r['last'] is None or date_spun >= r['last'])
+    if r['last'] is None:
+        r['first'], r['last'], r['momentum'] = date_spun, date_spun, 1.0
+        return r
+    day, last = to_ordinal(date_spun), to_ordinal(r['last'])
+    if not r['period'] > 0: # (No momentum to keep.)
+        r['last'] = max(r['last'], date_spun)
+        r['first'] = min(r['first'], date_spun)
+    elif day >= last: # Age the sum forward to the new spin.
+        r['momentum'] = r['momentum']*exp(-(day - last)/r['period']) + 1.0
+        r['last'] = date_spun
+    else: # A spin recorded after the fact
+        r['momentum'] += exp(-(last - day)/r['period'])
+        r['first'] = min(r['first'], date_spun)
+    return r
+
+def current_rollup(p):
+    """The rollup of p (a plate dict), if its history is in order and the
+    rollup agrees with it, or else None."""
+    r = p.get('rollup')
+    history = p.get('spin_history') or []
+    if r is None or not r['in_order'] or r['count'] != len(history):
+        return None
+    if len(history) > 0 and (history[0] != r['first'] or history[-1] != r['last']):
+        return None
+    return r
+
+def plate_rollup(plate):
+    """The rollup of a Plate, if it agrees with the plate's spins, or else
+    None."""
+    r = plate.rollup
+    days = plate.days
+    if r is None or r['count'] != len(days):
+        return None
+    if len(days) > 0 and (to_ordinal(r['first']) != days[0] or to_ordinal(r['last']) != days[-1]):
+        return None
+    return r
+
+def momentum_as_of(r, period, today):
+    """The angular momentum (see calculate_angular_momentum()) as of the day
+    ordinal today, or None if r's momentum isn't for this period."""
+    if r['period'] != period or not period > 0:
+        return None
+    if r['count'] == 0:
+        return 0.0
+    return r['momentum']*exp(-(today - to_ordinal(r['last']))/period)
+
+def compare_rollups(r, fresh):
+    """The fields in which rollup r differs from fresh (one just rebuilt from
+    the history)."""
+    if r is None:
+        return ['rollup']
+    fields = [field for field in ['count', 'first', 'last', 'months', 'period', 'in_order']
+        if r.get(field) != fresh[field]]
+    if not isclose(r.get('momentum', 0.0), fresh['momentum'], rel_tol=1e-9, abs_tol=1e-12):
+        fields.append('momentum')
+    return fields
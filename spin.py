@@ -18,18 +18,20 @@
 # > spin add pi
 
 
-import os, sys, re, requests, textwrap
-import fire
+# Startup time dominates one-shot commands like "spin trash", so only cheap
+# modules are imported here. Heavier ones (fire, numpy, pprint and notify) are
+# imported by the functions that need them.
+import os, sys, textwrap
 from math import exp
+from array import array
+from bisect import bisect_left, bisect_right
 
-from datetime import datetime, timedelta
-from dateutil import parser
-from collections import defaultdict
-from pprint import pprint
-from icecream import ic
-from json import loads, dumps
+from datetime import datetime, timedelta, time
+from contextlib import nullcontext
 from parameters.local_parameters import PLATES_FILE
-from notify import send_to_slack
+from storage import open_store, load_pauses, apply_history, StaleRackError, JournalError, SQLITE_EXTENSIONS
+from plate import Plate, RackMetrics, Wobbler, CodeIndex, METRICS, parse_history
+from dates import parse_date, parse_day, parse_last_spun, to_ordinals, format_day, format_last_spun
 
 def fib(n): return 1 if n in {0, 1} else fib(n-1) + fib(n-2)
 
@@ -40,57 +42,63 @@ def module_path(local_function):
    from http://stackoverflow.com/questions/729583/getting-file-path-of-imported-module'''
    # This function can be used to eliminate the need to define BASE_DIR in
    # parameters.local_parameters.py
-   import inspect, os
-   return os.path.abspath(inspect.getsourcefile(local_function))
+   # The function's code object knows its source file, which is what
+   # inspect.getsourcefile() would look up, without the cost of importing inspect.
+   return os.path.abspath(local_function.__code__.co_filename)
 
 try:
     PATH = '/'.join(module_path(fib).split('/')[:-1])
 except ModuleNotFoundError:
     from parameters.local_parameters import PATH
 
-def coerce_nulls_to_blanks(wobbly_plates, field):
-    for plate in wobbly_plates:
-        if field in plate:
-            if plate[field] is None:
-                plate[field] = ''
-
-def calculate_angular_momentum(p):
-    spins = p['spin_history']
-    period = p['period_in_days']
-    today = datetime.now().date()
-    L = sum([ exp( -(today-datetime.strptime(date_i,"%Y-%m-%d").date()).days/period ) for date_i in spins])
+NO_SPAN = nullcontext()
+
+def span(name):
+    # profiling is only imported for --profile (or SPIN_TRACE), and then it
+    # times the span (see profiling.span()).
+    profiling = sys.modules.get('profiling')
+    return NO_SPAN if profiling is None else profiling.span(name)
+
+def day_bounds(start_dt, end_dt):
+    """Convert the datetime range [start_dt, end_dt] into the range of day
+    ordinals whose midnights fall within it (which is how a spin date
+    compares against a datetime)."""
+    start = start_dt.toordinal()
+    if start_dt.time() != time(0):
+        start += 1
+    return start, end_dt.toordinal()
+
+def calculate_angular_momentum(days, period, today):
+    L = sum([ exp( -(today - d)/period ) for d in days])
     return L
 
-def spins_in_range(p, start_date, end_date):
+def spins_in_range(days, start, end):
     # This function is kind of a superset of spins_in_span().
-    count = 0
-    for spin in p['spin_history']:
-        if start_date <= parser.parse(spin).date() <= end_date:
-            count += 1
-    return count
-
-def calculate_streak(p):
-    spins = p['spin_history']
-    period = p['period_in_days']
-    end = datetime.now().date()
+    # start and end are day ordinals (inclusive), and since days is sorted,
+    # the count is just the distance between two binary searches.
+    return bisect_right(days, end) - bisect_left(days, start)
+
+def calculate_streak(days, period, today):
+    step = timedelta(days=period).days # Subtracting a fractional timedelta
+    # from a date only moves it by the whole number of days.
+    end = today
+    if step == 0: # Periods shorter than a day never move the window back,
+        # so count that one window just once.
+        return 1 if spins_in_range(days, end, end) > 0 else 0
     streak = 0
-    while spins_in_range(p, end - timedelta(days=period), end) > 0:
+    while spins_in_range(days, end - step, end) > 0:
         streak += 1
-        end -= timedelta(days=period)
+        end -= step
     return streak
 
-def calculate_spins_per_cycle(p):
-    spins = p['spin_history']
-    if len(spins) == 0:
+def calculate_spins_per_cycle(days, period, today):
+    if len(days) == 0:
         return 0.0000000
-    first_date = min(spins)
-    end = datetime.now().date()
-    total_days = end - parser.parse(first_date).date()
-    period = p['period_in_days']
-    cycles = total_days.days/period
+    total_days = today - days[0]
+    cycles = total_days/period
     if cycles < 1:
         cycles = 1
-    return len(spins)/cycles
+    return len(days)/cycles
 
 def character(count):
     if count == 0:
@@ -107,29 +115,60 @@ def character(count):
 def serialize_spin_counts(spins):
     return ''.join([character(count) for count in spins])
 
-def print_table(ps):
+CHECK_FIELDS = ['code', 'description', 'cycles_late', 'last_spun', 'period_in_days', 'status',
+    'angular_momentum', 'streak', 'average_spins', 'spins_by_cycle']
+
+def wobbler_records(wobblers, show_rack=False):
+    """The rows of check's table as records, for --format."""
+    for w in wobblers:
+        p = w.plate
+        record = {'rack': w.rack} if show_rack else {}
+        record.update({'code': p.code, 'description': p.description, 'cycles_late': w.cycles_late,
+            'last_spun': p.last_spun, 'period_in_days': p.period_in_days, 'status': p.status or 'Active'})
+        for field in ['angular_momentum', 'streak', 'average_spins', 'spins_by_cycle']:
+            record[field] = w.metric(field)
+        yield record
+
+def top_rows(rows, key, limit=None, reverse=False):
+    """Return sorted(rows, key=key, reverse=reverse)[:limit], using a heap
+    rather than sorting everything when there's a limit."""
+    if limit is None:
+        return sorted(rows, key=key, reverse=reverse)
+    from heapq import nsmallest, nlargest
+    return (nlargest if reverse else nsmallest)(limit, rows, key=key)
+
+def table_lines(ps, show_rack=False):
+    # ps is a list of Wobblers.
     template = "{{:<11.11}}  {{:<30.30}}  {}  {{:<10.10}}  {} {{:>6}} {} {{:>6}} {} {{}}"
+    rack_column = "{:<12.12}  " if show_rack else "" # For tables that mix racks
+    rule = "=" * (134 + len(rack_column.format("")))
     fmt = template.format("{:>7.8}","{:<6}","{:<3}", "{:>5}") # Formatting for headers for float columns
-    print(fmt.format("", "", "Cycles", "", "Period", "", "", "", "Per", ""))
-    print(fmt.format("Code","Description","late", "Last spun","in days", "Status", "L", "Streak", "cycle", "Spins by cycle"))
-    print("======================================================================================================================================")
-    fmt = template.format("{:>7.1f}","{:<7.1f}","{:<3.1f}", "{:>5.1f}") # The first digit in the float formatting
+    lines = [rack_column.format("") + fmt.format("", "", "Cycles", "", "Period", "", "", "", "Per", ""),
+        rack_column.format("Rack") + fmt.format("Code","Description","late", "Last spun","in days", "Status", "L", "Streak", "cycle", "Spins by cycle"),
+        rule]
+    fmt = rack_column + template.format("{:>7.1f}","{:<7.1f}","{:<3.1f}", "{:>5.1f}") # The first digit in the float formatting
     # strings has to be manually tweaked to make everything line up.
-    for p in ps:
-        if 'last_spun_dt' not in p or p['last_spun_dt'] is None:
+    for w in ps: # Wobblers
+        p = w.plate
+        if p.last_spun_dt is None:
             last_spun_date = ''
         else:
-            last_spun_date = datetime.strftime(p['last_spun_dt'],"%Y-%m-%d")
-        if 'status' not in p or p['status'] is None:
-            p['status'] = 'Active'
-        print(fmt.format(p['code'],p['description'],
-            p['cycles_late'], last_spun_date,
-            p['period_in_days'],p['status'],
-            p['angular_momentum'],
-            p['streak'],
-            p['average_spins'],
-            serialize_spin_counts(p['spins_by_cycle'])))
-    print("======================================================================================================================================\n")
+            last_spun_date = format_day(p.last_spun_dt)
+        rack = [w.rack or ''] if show_rack else []
+        lines.append(fmt.format(*rack, p.code,p.description,
+            w.cycles_late, last_spun_date,
+            p.period_in_days,p.status or 'Active',
+            w.metric('angular_momentum'),
+            w.metric('streak'),
+            w.metric('average_spins'),
+            serialize_spin_counts(w.metric('spins_by_cycle'))))
+    lines.append(rule)
+    return lines
+
+def print_table(ps, show_rack=False):
+    # The table is formatted into one string and written all at once (which
+    # matters when a big one is piped somewhere).
+    sys.stdout.write("\n".join(table_lines(ps, show_rack) + [""]) + "\n")
 
 #plates = {"trash": {"period_in_days": 3, "last_spun": "2017-10-22T22:40:06.500726", "description": "Put out the trash." }, "pi": {"period_in_days": 60, "last_spun": "2016-10-22T22:40:06.500726", "description": "Make cool thing for Raspberry Pi." } }
 #plates = [{"code": "trash", "period_in_days": 7, "last_spun": "2017-10-22T22:40:06.500726", "description": "Put out the trash." }, {"code": "pi", "period_in_days": 60, "last_spun": "2016-10-22T22:40:06.500726", "description": "Make cool thing for Raspberry Pi." } ]
@@ -137,45 +176,461 @@ def print_table(ps):
 #with open(PATH+"/plates.json",'w') as f:
 #    f.write(dumps(plates, indent=4))
 
+RACK_EXTENSIONS = ['.json'] + SQLITE_EXTENSIONS
+
+def is_rack_file(filepath):
+    # A JSON rack is a list of plates. Other JSON files that land in PATH (a
+    # Chrome trace from "--profile=check.json", say) are not racks.
+    if not filepath.endswith('.json'):
+        return True
+    with open(filepath,'rb') as f:
+        return f.read(64).lstrip()[:1] in [b'', b'[']
+
 def find_all_racks():
     from os import listdir
-    from os.path import isfile, join
-    import re
+    from os.path import isfile, join, splitext
     onlyfiles = [f for f in listdir(PATH) if isfile(join(PATH, f))]
-    return [re.sub("\.json","",f) for f in onlyfiles if re.search("json$",f)]
-
-def is_spinning(plate):
-    return 'status' not in plate or plate['status'] == 'Active'
+    return [splitext(f)[0] for f in onlyfiles
+        if splitext(f)[1] in RACK_EXTENSIONS and is_rack_file(join(PATH, f))]
+
+def rack_file(rack):
+    for extension in RACK_EXTENSIONS:
+        if os.path.isfile(os.path.join(PATH, rack + extension)):
+            return rack + extension
+
+class EvalContext(object):
+    """The moment that a command evaluates plates at. It's taken once, when
+    the command starts, so that every metric of every plate in a report is
+    measured against the same instant (and so that a report can be
+    reproduced, by passing an as_of date). An as_of date evaluates the rack
+    as it stood at the end of that day."""
+
+    def __init__(self, as_of=None):
+        self.as_of = as_of
+        if as_of is None:
+            self.now = datetime.now()
+        else:
+            self.now = datetime.combine(as_of, time.max)
+        self.today = self.now.date().toordinal()
 
-def last_spun_dt(plate):
-    if plate['last_spun'] is None:
-        last_spun = None
-    else:
-        last_spun = datetime.strptime(plate['last_spun'],"%Y-%m-%dT%H:%M:%S.%f")
-    return last_spun
+    def is_historical(self):
+        return self.as_of is not None
 
-def inspect(plates):
+    def visible(self, plates):
+        """Return the plates as they were as of the as_of date, without the
+        spins and pauses that came later. (Shelvings aren't dated, so each
+        plate keeps its current status.)"""
+        if not self.is_historical():
+            return plates
+        as_of = self.as_of.isoformat()
+        visible_plates = []
+        for p in plates:
+            p = dict(p)
+            if p.get('spin_history') is not None:
+                p['spin_history'] = [d for d in p['spin_history'] if d <= as_of]
+            if p['last_spun'] is not None and p['last_spun'][:10] > as_of:
+                history = sorted(p.get('spin_history') or [])
+                p['last_spun'] = history[-1] + "T00:00:00.000000" if len(history) > 0 else None
+            if 'pauses' in p:
+                p['pauses'] = [[start, end if end is None or end <= as_of else None]
+                    for start, end in p['pauses'] if start <= as_of]
+            visible_plates.append(p)
+        return visible_plates
+
+def inspect(plates, cache=None, context=None, show_all=False, announce=True):
+    """Compute the metrics of a list of Plates and return a Wobbler for each
+    plate that needs to be spun (or for every plate, with show_all, the rest
+    being 0 cycles late). announce prints a line for each overdue plate.
+    cache holds metrics computed before (under "spin serve", see
+    daemon.WarmMetrics), or is None to compute them all."""
+    now = (context or EvalContext()).now
+    if cache is None:
+        metrics = inspect_rack(plates, now)
+    else: # Only the plates that changed (or were last inspected on some
+        # other day) need to have their metrics recomputed.
+        metrics = RackMetrics(len(plates))
+        dirty = cache.fill(plates, metrics, now.date())
+        metrics.assign([i for i, key in dirty], inspect_rack([plates[i] for i, key in dirty], now))
+        cache.update(plates, metrics, dirty, now.date())
+    cycles_late = rack_lateness(plates, now)
     wobbly_plates = []
-    for i,plate in enumerate(plates):
-        plate['angular_momentum'] = calculate_angular_momentum(plate)
-        plate['streak'] = calculate_streak(plate)
-        plate['average_spins'] = calculate_spins_per_cycle(plate)
-        plate['spins_by_cycle'] = spins_by_cycle(plate['spin_history'], timedelta(days = 30*plate['period_in_days']), plate['period_in_days'])
-        if is_spinning(plate):
-            period_in_days = timedelta(days = plate['period_in_days']) 
-            last_spun = last_spun_dt(plate)
-            if last_spun is None or last_spun + period_in_days < datetime.now():
-                print("{} is overdue.".format(plate["code"]))
-                wobbler = dict(plate)
-                wobbler['last_spun_dt'] = last_spun
-                if last_spun is None:
-                    wobbler['cycles_late'] = 0
-                else:
-                    lateness = datetime.now() - (last_spun + period_in_days)
-                    wobbler['cycles_late'] = lateness.total_seconds()/period_in_days.total_seconds()
-                wobbly_plates.append(wobbler)
+    overdue = []
+    for i, (plate, lateness) in enumerate(zip(plates, cycles_late)):
+        if lateness is not None:
+            overdue.append("{} is overdue.\n".format(plate.code))
+            wobbly_plates.append(Wobbler(plate, metrics, i, lateness))
+    if announce:
+        sys.stdout.write(''.join(overdue))
+    if show_all: # The plates that are not wobbling come after the ones that are.
+        wobbly_plates += [Wobbler(plate, metrics, i, 0)
+            for i, (plate, lateness) in enumerate(zip(plates, cycles_late)) if lateness is None]
     return wobbly_plates
 
+def check_rack(rack, show_all=False, context=None):
+    """Load and inspect one rack. This runs in a worker process for check
+    --all-racks, so the "is overdue" lines are captured and returned rather
+    than printed (to keep the racks' lines from interleaving)."""
+    import io
+    from contextlib import redirect_stdout
+    from time import perf_counter
+    start = perf_counter()
+    plates = Plates(plates_file=rack_file(rack))
+    if context is not None:
+        plates.context = context
+    ps = plates.load_plates()
+    out = io.StringIO()
+    with redirect_stdout(out):
+        wobbly_plates = inspect(ps, None, plates.context, show_all)
+    for w in wobbly_plates:
+        w.rack = rack
+    return wobbly_plates, len(ps), out.getvalue(), perf_counter() - start
+
+def check_all_racks(show_all=False, context=None, limit=None, format='table'):
+    """Check every rack in PATH at once, one worker process per rack (up to
+    the number of CPUs), and show their wobbly plates in one table."""
+    from concurrent.futures import ProcessPoolExecutor
+    from time import perf_counter
+    start = perf_counter()
+    racks = sorted(find_all_racks())
+    if len(racks) == 0:
+        print("There are no racks in {}.".format(PATH))
+        return
+    with ProcessPoolExecutor(max_workers=min(len(racks), os.cpu_count() or 1)) as pool:
+        results = list(pool.map(check_rack, racks, [show_all]*len(racks), [context]*len(racks)))
+
+    wobbly_plates, plate_count = [], 0
+    for wobblers, count, overdue_lines, seconds in results:
+        if format == 'table':
+            sys.stdout.write(overdue_lines)
+        wobbly_plates += wobblers
+        plate_count += count
+    if format != 'table':
+        from formats import write_records
+        wobbly_ps_sorted = top_rows(wobbly_plates, key=lambda w: -w.cycles_late, limit=limit)
+        write_records(wobbler_records(wobbly_ps_sorted, show_rack=True), ['rack'] + CHECK_FIELDS, format)
+        return
+
+    print("\nPlates by Wobbliness (all racks): ")
+    print_table(top_rows(wobbly_plates, key=lambda w: -w.cycles_late, limit=limit), show_rack=True)
+
+    print("{:<12}  {:>6}  {:>6}  {:>8}".format("Rack", "Plates", "Wobbly", "Seconds"))
+    for rack, (wobblers, count, overdue_lines, seconds) in zip(racks, results):
+        print("{:<12.12}  {:>6}  {:>6}  {:>8.3f}".format(rack, count, len(wobblers), seconds))
+    print("{:<12}  {:>6}  {:>6}  {:>8.3f}\n".format("(wall clock)", plate_count, len(wobbly_plates), perf_counter() - start))
+
+    coda = "Out of {} plates in {} racks, {} need{} to be spun.".format(plate_count, len(racks), len(wobbly_plates), "s" if len(wobbly_plates) == 1 else "")
+    print(textwrap.fill(coda,70))
+
+##### RACK-WIDE METRICS #####
+# inspect_rack() computes the same metrics as the per-plate functions above, but
+# for a whole rack at once: the histories are packed into flat arrays and every
+# count is a vectorized binary search over them.
+
+MICROSECONDS_PER_DAY = 86400*10**6
+ORDINAL_BITS = 22 # Every date ordinal (up through the year 9999) fits in 22 bits.
+
+def microseconds(td):
+    return (td.days*86400 + td.seconds)*10**6 + td.microseconds
+
+def timestamp_us(dt):
+    # Measured from the start of ordinal day 0, so that
+    # timestamp_us(dt)//MICROSECONDS_PER_DAY == dt.toordinal().
+    return microseconds(dt - datetime.min) + MICROSECONDS_PER_DAY
+
+def pack_histories(plates):
+    """Pack the spin histories of a rack into flat ragged arrays. days holds
+    every plate's sorted day ordinals back to back (plate i's spins are
+    days[offsets[i]:offsets[i+1]]), and periods holds the period of each
+    plate."""
+    import numpy as np
+    flat = array('i')
+    offsets = [0]
+    for plate in plates:
+        flat.extend(plate.days)
+        offsets.append(len(flat))
+    days = np.asarray(flat, dtype=np.int64)
+    periods = np.array([plate.period_in_days for plate in plates], dtype=np.float64)
+    return np.array(offsets, dtype=np.int64), days, periods
+
+def count_in_ranges(keys, owners, lo, hi):
+    """The vectorized version of spins_in_range(): for each j, count the spins
+    of plate owners[j] falling on day ordinals lo[j] through hi[j]. keys holds
+    (plate index, day) pairs packed into single sorted integers."""
+    import numpy as np
+    top = (1 << ORDINAL_BITS) - 1
+    base = owners << ORDINAL_BITS
+    return (np.searchsorted(keys, base + np.clip(hi, -1, top), 'right')
+            - np.searchsorted(keys, base + np.clip(lo, 0, top), 'left'))
+
+def inspect_rack(plates, now):
+    """Compute angular momentum, streak, average spins per cycle and spins by
+    cycle for every plate in a list of Plates, returning them as RackMetrics."""
+    import numpy as np
+    n = len(plates)
+    index = np.arange(n)
+    offsets, days, periods = pack_histories(plates)
+    lengths = np.diff(offsets)
+    owner = np.repeat(index, lengths)
+    keys = (owner << ORDINAL_BITS) + days
+    today = now.date().toordinal()
+    now_us = timestamp_us(now)
+
+    # Angular momentum is a decay-weighted sum over each plate's spins. The
+    # rollups (see rollup.py) hold the sums as of each plate's last spin, so
+    # the sum is only taken here for the plates without a usable one.
+    from rollup import plate_rollup, momentum_as_of
+    rolled_up = [None]*n
+    for i, plate in enumerate(plates):
+        r = plate_rollup(plate)
+        if r is not None:
+            rolled_up[i] = momentum_as_of(r, plate.period_in_days, today)
+    summed = np.array([momentum is None for momentum in rolled_up], dtype=bool)[owner]
+    decay = np.exp(-(today - days[summed])/periods[owner[summed]])
+    angular_momentum = np.bincount(owner[summed], weights=decay, minlength=n).astype(np.float64) # (An
+    # empty bincount comes back as integers.)
+    for i, momentum in enumerate(rolled_up):
+        if momentum is not None:
+            angular_momentum[i] = momentum
+
+    # Average spins per cycle since the first spin
+    spun = lengths > 0
+    first = np.full(n, today, dtype=np.int64)
+    first[spun] = days[offsets[:-1][spun]]
+    cycles = np.maximum((today - first)/periods, 1)
+    average_spins = np.where(spun, lengths/cycles, 0.0)
+
+    # Streaks are extended one cycle at a time for all the plates that are
+    # still on a streak, so this takes as many rounds as the longest streak.
+    steps = np.array([timedelta(days=period).days for period in periods.tolist()], dtype=np.int64)
+    streak = np.zeros(n, dtype=np.int64)
+    end = np.full(n, today, dtype=np.int64)
+    live = index
+    while len(live) > 0:
+        hit = count_in_ranges(keys, live, end[live] - steps[live], end[live]) > 0
+        streak[live[hit]] += 1
+        end[live] -= steps[live]
+        live = live[hit & (steps[live] > 0)] # A step of zero never moves the window.
+
+    # Spins by cycle: bin k (counting back from now) runs from now - k*cycle to
+    # now - (k-1)*cycle, for every k with k*cycle < the 30-cycle span.
+    cycle_us = np.array([microseconds(timedelta(days=period)) for period in periods.tolist()], dtype=np.int64)
+    span_us = np.array([microseconds(timedelta(days=30*period)) for period in periods.tolist()], dtype=np.int64)
+    n_bins = np.where(cycle_us > 0, -(-span_us//np.maximum(cycle_us, 1)) - 1, 0)
+    n_bins = np.maximum(n_bins, 0)
+    bin_offsets = np.concatenate(([0], np.cumsum(n_bins)))
+    bin_owner = np.repeat(index, n_bins)
+    k = n_bins[bin_owner] - (np.arange(bin_offsets[-1]) - bin_offsets[:-1][bin_owner]) # Oldest bin first
+    cycle_end_us = now_us - (k - 1)*cycle_us[bin_owner]
+    cycle_start_us = cycle_end_us - cycle_us[bin_owner]
+    counts = count_in_ranges(keys, bin_owner,
+        -(-cycle_start_us//MICROSECONDS_PER_DAY), # The first midnight at or after the start
+        cycle_end_us//MICROSECONDS_PER_DAY)
+
+    counts = counts.tolist()
+    bin_offsets = bin_offsets.tolist()
+    metrics = RackMetrics(0)
+    metrics.angular_momentum = angular_momentum.tolist()
+    metrics.streak = streak.tolist()
+    metrics.average_spins = average_spins.tolist()
+    metrics.spins_by_cycle = [counts[bin_offsets[i]:bin_offsets[i+1]] for i in range(n)]
+    return metrics
+
+def rack_lateness(plates, now):
+    """Return each plate's cycles_late, or None for the plates that are not
+    both spinning and overdue."""
+    import numpy as np
+    last_spuns = [plate.last_spun_dt for plate in plates]
+    cycle_us = np.array([microseconds(timedelta(days=plate.period_in_days)) for plate in plates], dtype=np.int64)
+    spinning = np.array([plate.is_spinning() for plate in plates], dtype=bool)
+    never_spun = np.array([last_spun is None for last_spun in last_spuns], dtype=bool)
+    last_us = np.array([0 if last_spun is None else timestamp_us(last_spun) for last_spun in last_spuns], dtype=np.int64)
+    now_us = timestamp_us(now)
+    overdue = spinning & (never_spun | (last_us + cycle_us < now_us))
+    lateness = np.where(never_spun, 0, (now_us - last_us - cycle_us)/np.where(cycle_us > 0, cycle_us, 1))
+    return [late if is_overdue else None for late, is_overdue in zip(lateness.tolist(), overdue.tolist())]
+
+##### SHARDED INSPECTION #####
+# With --workers N, check, all and stats split the rack into N contiguous
+# shards and compute the metrics in a process pool. A shard travels to its
+# worker as a few flat values (all of its spin dates joined into one string,
+# plus arrays of history lengths and periods) rather than as plate dicts, and
+# the worker parses the dates (each distinct date once), runs inspect_rack()
+# and rack_lateness() on its plates and sends back arrays, with its rows
+# already sorted. The parent then just merges the shards' orders (heapq.merge)
+# for each table. The daemon's warm metrics are bypassed, since the workers
+# recompute everything anyway. See benchmarks/workers.py for where this starts to pay.
+
+def shard_bounds(n, workers):
+    size = -(-n // max(1, workers))
+    return [(a, min(a + size, n)) for a in range(0, n, max(1, size))]
+
+def pack_shard(ps):
+    """Flatten a list of plate dicts into the few values a worker needs."""
+    dates, lengths = [], array('i')
+    for p in ps:
+        history = p.get('spin_history') or []
+        dates += history
+        lengths.append(len(history))
+    return {'dates': '\n'.join(dates), 'lengths': lengths,
+        'periods': array('d', [p['period_in_days'] for p in ps]),
+        'last_spun': '\n'.join(p.get('last_spun') or '' for p in ps),
+        'statuses': '\n'.join(p.get('status') or '' for p in ps),
+        'has_history': bytes(1 if 'spin_history' in p else 0 for p in ps),
+        'pauses': [(k, p['pauses']) for k, p in enumerate(ps) if p.get('pauses')]}
+
+def unpack_shard(shard):
+    """Rebuild a shard's plates as Plate records (with just the fields that
+    the metrics use), along with the first date in each spin history."""
+    ordinals = to_ordinals(shard['dates'].split('\n')) if len(shard['dates']) > 0 else []
+    plates, firsts, start = [], array('i'), 0
+    for length, period, last_spun, status in zip(shard['lengths'], shard['periods'],
+            shard['last_spun'].split('\n'), shard['statuses'].split('\n')):
+        plate = Plate()
+        history = ordinals[start:start + length]
+        plate.days = array('i', sorted(history))
+        plate.period_in_days = period
+        plate.last_spun_dt = parse_last_spun(last_spun) if last_spun else None
+        plate.status = status or None
+        plate.rollup = None
+        plates.append(plate)
+        firsts.append(history[0] if length > 0 else 0)
+        start += length
+    return plates, firsts
+
+def lateness_key(late, k):
+    # The order of check's first table: the latest first, then the plates
+    # that are only there because of show_all, each group in rack order.
+    return (-late[k] if late[k] == late[k] else 0.0, late[k] != late[k], k)
+
+def recency_key(late, last_us, k):
+    return (last_us[k], late[k] != late[k], k) # Never-spun plates (-1) first
+
+def inspect_shard(shard, context, show_all=False):
+    import math
+    plates, firsts = unpack_shard(shard)
+    now = context.now
+    metrics = inspect_rack(plates, now)
+    late = array('d', [math.nan if lateness is None else lateness for lateness in rack_lateness(plates, now)])
+    last_us = array('q', [-1 if plate.last_spun_dt is None else timestamp_us(plate.last_spun_dt) for plate in plates])
+    rows = [k for k in range(len(plates)) if show_all or late[k] == late[k]]
+    days = array('i')
+    for plate in plates:
+        days.extend(plate.days)
+    spins_by_cycle = array('i')
+    for counts in metrics.spins_by_cycle:
+        spins_by_cycle.extend(counts)
+    return {'days': days, 'cycles_late': late, 'last_us': last_us,
+        'angular_momentum': array('d', metrics.angular_momentum), 'streak': array('q', metrics.streak),
+        'average_spins': array('d', metrics.average_spins), 'spins_by_cycle': spins_by_cycle,
+        'bins': array('i', [len(counts) for counts in metrics.spins_by_cycle]),
+        'by_lateness': array('i', sorted(rows, key=lambda k: lateness_key(late, k))),
+        'by_recency': array('i', sorted(rows, key=lambda k: recency_key(late, last_us, k)))}
+
+def map_shards(function, ps, workers, *args):
+    """Run function(shard, *args) on each shard of ps in a process pool.
+    Returns the (start, end) bounds of the shards and their results."""
+    from concurrent.futures import ProcessPoolExecutor
+    bounds = shard_bounds(len(ps), workers)
+    shards = [pack_shard(ps[a:b]) for a, b in bounds]
+    with ProcessPoolExecutor(max_workers=max(1, len(bounds))) as pool:
+        results = list(pool.map(function, shards, *[[arg]*len(bounds) for arg in args]))
+    return bounds, results
+
+def merge_shards(bounds, orders, key, limit=None):
+    """k-way merge of the shards' sorted rows (local indices) by key (a
+    function of the global index)."""
+    from heapq import merge
+    from itertools import islice
+    merged = merge(*[[a + k for k in order] for (a, b), order in zip(bounds, orders)], key=key)
+    return list(islice(merged, limit))
+
+def inspect_sharded(ps, context, show_all=False, workers=2, limit=None, announce=True):
+    """inspect() in a process pool (for a list of plate dicts). Returns the
+    Wobblers sorted by lateness and by recency (up to limit of each) and the
+    total number of Wobblers."""
+    bounds, results = map_shards(inspect_shard, ps, workers, context, show_all)
+    late, last_us = array('d'), array('q')
+    metrics = RackMetrics(0)
+    for field in METRICS:
+        setattr(metrics, field, [])
+    days, day_offsets = [], []
+    for (a, b), result in zip(bounds, results):
+        late.extend(result['cycles_late'])
+        last_us.extend(result['last_us'])
+        metrics.angular_momentum += result['angular_momentum'].tolist()
+        metrics.streak += result['streak'].tolist()
+        metrics.average_spins += result['average_spins'].tolist()
+        counts, start = result['spins_by_cycle'].tolist(), 0
+        for n_bins in result['bins']:
+            metrics.spins_by_cycle.append(counts[start:start + n_bins])
+            start += n_bins
+        start = 0
+        for p in ps[a:b]:
+            length = len(p.get('spin_history') or [])
+            days.append(result['days'])
+            day_offsets.append((start, start + length))
+            start += length
+    if announce:
+        sys.stdout.write(''.join("{} is overdue.\n".format(ps[k]['code']) for k in range(len(ps)) if late[k] == late[k]))
+
+    plates = {} # Only the plates that make it into a table are converted.
+    def wobbler(k):
+        if k not in plates:
+            start, end = day_offsets[k]
+            plates[k] = Plate.from_dict(ps[k], days[k][start:end])
+        return Wobbler(plates[k], metrics, k, late[k] if late[k] == late[k] else 0)
+    with span('merge'):
+        by_lateness = merge_shards(bounds, [result['by_lateness'] for result in results],
+            lambda k: lateness_key(late, k), limit)
+        by_recency = merge_shards(bounds, [result['by_recency'] for result in results],
+            lambda k: recency_key(late, last_us, k), limit)
+    count = sum(len(result['by_lateness']) for result in results)
+    return [wobbler(k) for k in by_lateness], [wobbler(k) for k in by_recency], count
+
+def stats_shard(shard, context):
+    import math
+    plates, firsts = unpack_shard(shard)
+    pauses = dict(shard['pauses'])
+    now = context.now
+    in_last_n_cycles, effective_periods = array('i'), array('d')
+    for k, plate in enumerate(plates):
+        n = 2
+        span = timedelta(n*plate.period_in_days)
+        in_last_n_cycles.append(spins_in_span(plate.days,span,context))
+        effective_period = math.nan
+        if len(plate.days) > 1:
+            first_datetime = datetime.fromordinal(firsts[k])
+            paused = PauseIndex(pauses.get(k, []), now).paused_between(first_datetime, now)
+            effective_period = (now - first_datetime - paused).days/(len(plate.days) - 1.0)
+        effective_periods.append(effective_period)
+    # The order of the stats table: the longest effective periods first, with
+    # the plates that have fewer than two spins ahead of them all.
+    rows = [k for k in range(len(plates)) if shard['has_history'][k]]
+    order = sorted(rows, key=lambda k: (-effective_periods[k] if len(plates[k].days) > 1 else -99999, k))
+    return {'in_last_n_cycles': in_last_n_cycles, 'effective_period': effective_periods, 'order': array('i', order)}
+
+def stats_sharded(ps, context, workers=2, limit=None):
+    """The rows of the stats table for a list of plate dicts, in order,
+    computed in a process pool."""
+    bounds, results = map_shards(stats_shard, ps, workers, context)
+    in_last_n_cycles, effective_periods = array('i'), array('d')
+    for result in results:
+        in_last_n_cycles.extend(result['in_last_n_cycles'])
+        effective_periods.extend(result['effective_period'])
+    totals = [len(p.get('spin_history') or []) for p in ps]
+    rows = []
+    for k in merge_shards(bounds, [result['order'] for result in results],
+            lambda k: (-effective_periods[k] if totals[k] > 1 else -99999, k), limit):
+        p = ps[k]
+        rows.append({'status': p.get('status', 'Active'),
+            'code': p['code'],
+            'total_spins': totals[k],
+            'in_last_n_cycles': in_last_n_cycles[k],
+            'description': p['description'],
+            'period_in_days': p['period_in_days'],
+            'effective_period': effective_periods[k] if totals[k] > 1 else ("None" if totals[k] == 1 else "")})
+    return rows
+
 def intersection(start1,end1,start2,end2):
     start = max(start1,start2)
     end = min(end1,end2)
@@ -184,83 +639,134 @@ def intersection(start1,end1,start2,end2):
         diff = timedelta(days = 0)
     return diff
 
-def is_more_in(start,span,ranges):
+def is_more_in(start,span,ranges,context=None):
     """Determine whether a given time span (from start to start+span)
     is more in the periods represented by ranges (where ranges
     has the form [(begin1,end1),(begin2,end2),...(beginN,None)]."""
-
-    cumulative = timedelta(days=0)
-
-    end = start + span
-    if end > datetime.now():
-        end = datetime.now()
-
-    for r in ranges:
-
-        r_start_dt = datetime.strptime(r[0],"%Y-%m-%d")
-        if r[1] is None:
-            r_end_dt = datetime.now()
-        else:
-            r_end_dt = datetime.strptime(r[1],"%Y-%m-%d")
-        cumulative += intersection(start,end,r_start_dt,r_end_dt)
-    return cumulative + cumulative > end - start
-
-def spins_in_span(spin_history,span):
-    now = datetime.now()
-    start = now - span
-    in_span = [s for s in spin_history if start <= datetime.strptime(s,"%Y-%m-%d") <= now]
-    return len(in_span)
-
-def spins_by_cycle(spin_history,span,cycle_length):
-    now = datetime.now()
+    now = (context or EvalContext()).now
+    return PauseIndex(ranges, now).is_more_paused(start, min(start + span, now))
+
+class PauseIndex(object):
+    """A plate's pauses, parsed once, for measuring how much of a time window
+    the plate spent paused. The time paused up through t is the sum over the
+    pauses of (t - start) for those that had started by t, minus (t - end) for
+    those that had ended by t, so with the starts and ends sorted and summed
+    cumulatively, it takes a binary search in each. Times are integer
+    microseconds (see timestamp_us()) from the earliest start, so the
+    arithmetic is exact. Ongoing pauses end at now, and overlapping pauses
+    count twice (as they did in is_more_in)."""
+
+    def __init__(self, ranges, now):
+        from itertools import accumulate
+        intervals = []
+        for r in ranges:
+            start = timestamp_us(parse_day(r[0]))
+            end = timestamp_us(now if r[1] is None else parse_day(r[1]))
+            if end > start: # A pause that ends before it starts covers nothing.
+                intervals.append((start, end))
+        self.origin = min([start for start, end in intervals], default=0)
+        self.starts = sorted(start - self.origin for start, end in intervals)
+        self.ends = sorted(end - self.origin for start, end in intervals)
+        self.start_sums = list(accumulate(self.starts, initial=0))
+        self.end_sums = list(accumulate(self.ends, initial=0))
+
+    def paused_through(self, t):
+        t -= self.origin
+        started = bisect_right(self.starts, t)
+        ended = bisect_right(self.ends, t)
+        return (started*t - self.start_sums[started]) - (ended*t - self.end_sums[ended])
+
+    def paused_between(self, start_dt, end_dt):
+        """The time paused between start_dt and end_dt, as a timedelta."""
+        if end_dt <= start_dt:
+            return timedelta(0)
+        return timedelta(microseconds=self.paused_through(timestamp_us(end_dt)) - self.paused_through(timestamp_us(start_dt)))
+
+    def is_more_paused(self, start_dt, end_dt):
+        return 2*self.paused_between(start_dt, end_dt) > end_dt - start_dt
+
+    def more_paused(self, window_starts, window_ends):
+        """The vectorized is_more_paused, for NumPy arrays of window starts and
+        ends (as timestamp_us() values)."""
+        import numpy as np
+        start_sums = np.array(self.start_sums, dtype=np.int64)
+        end_sums = np.array(self.end_sums, dtype=np.int64)
+        def paused_through(t):
+            t = t - self.origin
+            started = np.searchsorted(self.starts, t, side='right')
+            ended = np.searchsorted(self.ends, t, side='right')
+            return (started*t - start_sums[started]) - (ended*t - end_sums[ended])
+        paused = np.where(window_ends > window_starts, paused_through(window_ends) - paused_through(window_starts), 0)
+        return 2*paused > window_ends - window_starts
+
+def spins_in_span(days,span,context=None):
+    now = (context or EvalContext()).now
+    start, end = day_bounds(now - span, now)
+    return spins_in_range(days, start, end)
+
+def spins_in_history(spin_history,span,context=None):
+    """spins_in_span() for a spin history that's in order (see rollup.py),
+    searching the "%Y-%m-%d" strings (which sort as the dates do) rather than
+    parsing them."""
+    now = (context or EvalContext()).now
+    start, end = day_bounds(now - span, now)
+    return (bisect_right(spin_history, format_day(datetime.fromordinal(end)))
+        - bisect_left(spin_history, format_day(datetime.fromordinal(start))))
+
+def spins_in_last_cycles(p,span,context=None):
+    # The spin history only needs to be parsed if it's not known to be in order.
+    from rollup import current_rollup
+    if current_rollup(p) is not None:
+        return spins_in_history(p['spin_history'] or [],span,context)
+    return spins_in_span(parse_history(p['spin_history']),span,context)
+
+def spins_by_cycle(days,span,cycle_length,context=None):
+    now = (context or EvalContext()).now
     cycle_end = now
     cycle_start = cycle_end - timedelta(days=cycle_length)
     spins = []
     while cycle_start > now - span:
-        in_cycle = [s for s in spin_history if cycle_start <= datetime.strptime(s,"%Y-%m-%d") <= cycle_end] # This is
-        # NOT an efficient way of dividing the spins among the spin bins.
-        spins = [len(in_cycle)] + spins
-        cycle_end = cycle_start + timedelta(days=0)
+        start, end = day_bounds(cycle_start, cycle_end)
+        spins.append(spins_in_range(days, start, end)) # Each bin is counted
+        # with two binary searches rather than a scan of the whole history.
+        cycle_end = cycle_start
         cycle_start = cycle_end - timedelta(days=cycle_length)
+    spins.reverse() # Oldest cycle first
     return spins
 
-def form_bar(p,start_dt,end_dt,terminator):
+def bar_parts(p,start_dt,end_dt,context=None):
+    """The pieces of a plate's row of the project view: the spins in the last
+    two cycles, the duration in weeks and the bar itself."""
     unit = timedelta(days = 7)
-    fmt = "{:<11.11} {:>3}  {:>3} {:<}{}"
     duration = int((end_dt - start_dt).days/7.0) # in weeks
     #duration_less_one = duration-1 if duration > 0 else 0
     #d_bar = '|' * duration_less_one
-    pauses = load_pauses(p)
-    d = start_dt
-    d_bar = ''
-    while d < end_dt:
-        if is_more_in(d,unit,pauses):
-            d_bar += '"'
-        else:
-            d_bar += '|'
-        d += unit
+    context = context or EvalContext()
+    now = context.now
+    pauses = PauseIndex(load_pauses(p), now)
+    # One character per week from start_dt up to end_dt, with the week's
+    # window cut off at the present, and all of the weeks checked at once.
+    import numpy as np
+    unit_us = microseconds(unit)
+    weeks = max(0, -(-microseconds(end_dt - start_dt) // unit_us))
+    week_starts = timestamp_us(start_dt) + unit_us*np.arange(weeks, dtype=np.int64)
+    week_ends = np.minimum(week_starts + unit_us, timestamp_us(now))
+    d_bar = ''.join(np.where(pauses.more_paused(week_starts, week_ends), '"', '|'))
 
     if len(d_bar) > 0:
         d_bar = d_bar[:-1]
     n = 2
     span = timedelta(n*p['period_in_days'])
-    if p['spin_history'] is not None:
-        spin_history = p['spin_history'] # A list of date_strings
-    else:
-        spin_history = []
-    in_last_n_cycles = spins_in_span(spin_history,span)
+    in_last_n_cycles = spins_in_last_cycles(p,span,context)
+    return in_last_n_cycles, duration, d_bar
 
+def form_bar(p,start_dt,end_dt,terminator,context=None):
+    fmt = "{:<11.11} {:>3}  {:>3} {:<}{}"
+    in_last_n_cycles, duration, d_bar = bar_parts(p,start_dt,end_dt,context)
     bar = fmt.format(p['code'], in_last_n_cycles, duration, d_bar, terminator)
     return bar
 
-def load_pauses(p):
-    if 'pauses' in p:
-        pauses = p['pauses'] # A list of 2-element lists, with the first element being the
-        # beginning of the pause and the second being the end of the pause (equal to None) if
-        # the pause is ongoing.
-    else:
-        pauses = []
-    return pauses
+EDITABLE_FIELDS = ['description', 'period_in_days', 'last_spun']
 
 def prompt_for(input_field):
     try:
@@ -282,100 +788,239 @@ class Plates(object):
 
     def __init__(self, plates_file=PLATES_FILE):
         self._filepath = PATH+"/"+plates_file
+        self._store = open_store(self._filepath) # JSON or SQLite, depending
+        # on the extension of the plates file
+        self.warm_metrics = None # Set by "spin serve" (see daemon.WarmMetrics)
+        self._code_index = None # (rack version, CodeIndex)
+        self.context = EvalContext() # main() replaces this for each command.
 
     def __str__(self):
         return self._filepath
 
     def load(self):
-        #plates_filepath = PATH+"/"+PLATES_FILE
-        plates_filepath = self._filepath
-        if os.path.exists(plates_filepath):
-            with open(plates_filepath,'r') as f:
-                plates = loads(f.read())
-            return plates
-        else:
-            return []
+        return self._store.load()
+
+    def load_visible(self):
+        """Load the plates as of the context's date (for reports)."""
+        return self.context.visible(self.load())
+
+    def load_plates(self):
+        """Load the plates (as of the context's date) as Plate records."""
+        if not self.context.is_historical() and hasattr(self._store, 'plate_records'):
+            return self._store.plate_records() # (Kept warm by "spin serve")
+        plates = self.load_visible()
+        for k, p in enumerate(plates): # Each dict can go as soon as it's converted.
+            plates[k] = Plate.from_dict(p)
+        return plates
+
+    def code_index(self):
+        # Rebuilt only when the rack changes (which matters under "spin serve").
+        version = self._store.version()
+        if self._code_index is None or self._code_index[0] != version:
+            self._code_index = (version, CodeIndex(self._store.codes()))
+        return self._code_index[1]
 
     def store(self,plates):
-        with open(self._filepath,'w') as f:
-            f.write(dumps(plates, indent=4))
-
-    def check(self,show_all=False):
-        plates = self.load()
-        wobbly_plates = inspect(plates)
-        if show_all:
-            all_plates_with_lateness = wobbly_plates
-            for p in plates:
-                if p['code'] not in [q['code'] for q in all_plates_with_lateness]:
-                    p['cycles_late'] = 0
-                    p['last_spun_dt'] = last_spun_dt(p)
-                    all_plates_with_lateness.append(p)
-            wobbly_plates = all_plates_with_lateness
-
-        coerce_nulls_to_blanks(wobbly_plates, 'last_spun') # A hack to address the difficulty of sorting wobbly_plates by recency with None values.
-        # [ ] It might be better to just fix the sorting or switch away from using None values in storing the data.
-
-        wobbly_ps_sorted = sorted(wobbly_plates, 
-                                key=lambda u: -u['cycles_late'])
+        self._store.store(plates)
+
+    def compact(self):
+        """Fold the journal of spins and shelvings back into the rack file."""
+        folded = self._store.compact()
+        if folded == 0:
+            print("There are no journal entries to fold in.")
+        else:
+            print("Folded {} journal entries into {}.".format(folded, self._filepath))
+
+    def reindex(self, check=False):
+        """Rebuild each plate's rollup (the summary of its spin history that
+        the reports read, which every spin updates), checking the old rollups
+        and the rebuilt ones against the full histories. With --check, just
+        report what's out of date.
+        > spin reindex --check"""
+        from math import isclose
+        from rollup import build_rollup, compare_rollups, momentum_as_of, decode_months
+        version = self._store.version()
+        ps = self.load()
+        today = self.context.today
+        missing, stale, wrong = 0, [], []
+        for p in ps:
+            fresh = build_rollup(p.get('spin_history'), p['period_in_days'])
+            if p.get('rollup') is None:
+                missing += 1
+            else:
+                fields = compare_rollups(p['rollup'], fresh)
+                if len(fields) > 0:
+                    stale.append("{} ({})".format(p['code'], ', '.join(fields)))
+            # What the reports get from the rollup has to match what they
+            # would compute from the history.
+            days = parse_history(p.get('spin_history'))
+            momentum = momentum_as_of(fresh, p['period_in_days'], today)
+            if (fresh['count'] != len(days) or sum(decode_months(fresh['months'])[1]) != len(days)
+                    or (momentum is not None and not isclose(momentum,
+                        calculate_angular_momentum(days, p['period_in_days'], today), rel_tol=1e-9, abs_tol=1e-12))):
+                wrong.append(p['code'])
+            p['rollup'] = fresh
+        if len(wrong) > 0: # (Which would be a bug in rollup.py.)
+            print("The rebuilt rollups of these plates don't match their histories: {}".format(', '.join(wrong)))
+            return
+        if missing == 0 and len(stale) == 0:
+            print("All {} rollups are up to date.".format(len(ps)))
+            return
+        if missing > 0:
+            print("{} of {} plates had no rollup.".format(missing, len(ps)))
+        if len(stale) > 0:
+            print("{} rollups were out of date:\n    {}".format(len(stale), '\n    '.join(stale)))
+        if check:
+            return
+        try:
+            self._store.store(ps, expected_version=version)
+        except StaleRackError:
+            print("The rack changed while it was being reindexed. Try again.")
+            return
+        print("Rebuilt the rollups in {}.".format(self._filepath))
+
+    def export_rack(self, filepath):
+        """Write the rack out to another rack file, in the format given by that
+        file's extension (e.g., to convert a JSON rack to SQLite or back).
+        > spin export_rack /path/to/plates.sqlite"""
+        open_store(filepath).store(self.load())
+        print("Exported {} to {}.".format(self._filepath, filepath))
+
+    def import_rack(self, filepath):
+        """Replace this rack with the plates in another rack file (JSON or SQLite).
+        > spin import_rack /path/to/plates.json"""
+        plates = open_store(filepath).load()
+        self.store(plates)
+        print("Imported {} plates from {}.".format(len(plates), filepath))
+
+    def check(self,show_all=False,all_racks=False,limit=None,format='table',workers=1):
+        """Show the plates that need to be spun.
+        > spin check --all-racks (checks every rack in PATH, in parallel)
+        > spin check --limit 10 (shows just the 10 wobbliest and least recently spun)
+        > spin check --format jsonl (or json, csv or arrow: one record per plate,
+        by wobbliness)
+        > spin check --workers 4 (splits a big rack across 4 processes)"""
+        from formats import is_format
+        if not is_format(format):
+            return
+        if all_racks:
+            return check_all_racks(show_all, self.context, limit, format)
+        if workers > 1:
+            ps = self.load_visible()
+            plate_count = len(ps)
+            wobbly_ps_sorted, wobbly_ps_by_recency, wobbly_count = inspect_sharded(ps, self.context,
+                show_all, workers, limit, announce=(format == 'table'))
+            del ps
+        else:
+            plates = self.load_plates()
+            plate_count = len(plates)
+            wobbly_plates = inspect(plates, # (Historical reports would just churn the warm metrics.)
+                None if self.context.is_historical() else self.warm_metrics, self.context, show_all,
+                announce=(format == 'table'))
+            wobbly_count = len(wobbly_plates)
+            with span('sort'):
+                wobbly_ps_sorted = top_rows(wobbly_plates,
+                                    key=lambda w: -w.cycles_late, limit=limit)
+                wobbly_ps_by_recency = top_rows(wobbly_plates, # Never-spun plates first
+                                    key=lambda w: w.plate.last_spun_dt or datetime.min, limit=limit)
+        if format != 'table':
+            from formats import write_records
+            write_records(wobbler_records(wobbly_ps_sorted), CHECK_FIELDS, format)
+            return
+
         print("\nPlates by Wobbliness: ")
         print_table(wobbly_ps_sorted)
 
-        wobbly_ps_by_recency = sorted(wobbly_plates, 
-                                key=lambda u: u['last_spun'])
         print("\n\nWobbly Plates by Date of Last Spinning: ")
         print_table(wobbly_ps_by_recency)
 
 
-        coda = "Out of {} plates, {} need{} to be spun.".format(len(plates), len(wobbly_plates), "s" if len(wobbly_plates) == 1 else "")
+        coda = "Out of {} plates, {} need{} to be spun.".format(plate_count, wobbly_count, "s" if wobbly_count == 1 else "")
         print(textwrap.fill(coda,70))
 
-    def all(self):
-        self.check(show_all=True)
-
-    def total(self, aggregate_by='month'):
-        plates = self.load()
-        #for days_ago in range(0,30):
-        history = []
-        for p in plates:
-            history += p['spin_history']
-
-        totals_by = defaultdict(int)
-        for d in history:
-            if aggregate_by == 'month':
-                term = d[:7]
-            elif aggregate_by == 'year':
-                term = d[:4]
+    def all(self,limit=None,format='table',workers=1):
+        self.check(show_all=True,limit=limit,format=format,workers=workers)
+
+    def watch(self,interval=2,limit=None):
+        """Keep the table of wobbly plates on the screen, updating it as the
+        rack changes (and as time passes).
+        > spin watch --interval 10 --limit 20"""
+        if getattr(sys.stdout, 'buffer', None) is None: # Under "spin serve", stdout
+            # is captured, so have the client run this itself.
+            from daemon import NeedsTerminal
+            raise NeedsTerminal('watch')
+        import watch
+        watch.watch(sys.modules[__name__], self, float(interval), limit)
+
+    def total(self, aggregate_by='month', status=None, code=None, since=None, until=None, by_plate=False,
+            format='table'):
+        """Count spins by day, week (ISO), month, quarter or year.
+        > spin total week --since 2024-01-01 --until 2024-03-31
+        > spin total quarter --status Active,Paused --code "p00*" --by_plate"""
+        from formats import is_format
+        from aggregate import AGGREGATIONS, count_spins
+        if not is_format(format):
+            return
+        if aggregate_by not in AGGREGATIONS:
+            print("The aggregations are {}.".format(', '.join(AGGREGATIONS)))
+            return
+        if isinstance(status, str):
+            status = status.split(',')
+        try:
+            since, until = [None if d is None else parse_date(str(d))
+                for d in [since, until]]
+        except ValueError:
+            print("--since and --until take dates in the form YYYY-MM-DD.")
+            return
+        totals_by = count_spins(self.load_visible(), aggregate_by, status, code, since, until, by_plate)
+        if format != 'table':
+            from formats import write_records
+            if by_plate:
+                records = ({'code': c, 'term': term, 'spins': spins}
+                    for c, terms in totals_by.items() for term, spins in terms.items())
+                write_records(records, ['code', 'term', 'spins'], format)
             else:
-                raise ValueError(f'No idea how to aggregate by {term}.')
-            totals_by[term] += 1
+                records = ({'term': term, 'spins': spins} for term, spins in totals_by.items())
+                write_records(records, ['term', 'spins'], format)
+            return
+        from pprint import pprint
         pprint(totals_by)
 
     def total_by_year(self):
         aggregate_by = 'year'
         self.total(aggregate_by = 'year')
 
-    def view(self,code=None):
-        plates = self.load()
+    def prompt_for_code(self, code, verb):
+        """Resolve code (a plate's code or the start of one), prompting until
+        it picks out exactly one plate."""
+        index = self.code_index()
         if code is None:
-            print("You have to specify the code of an existing plate to view.")
-            print("Here are the current plates: {}\n".format(', '.join([p['code'] for p in plates])))
+            print("You have to specify the code of an existing plate to {}.".format(verb))
+            print("Here are the current plates: {}\n".format(', '.join(index.codes)))
             code = prompt_for('Enter the code')
-        plate_codes = [p['code'] for p in plates]
-        while code not in plate_codes:
-            print("There's no plate under that code. Try again.")
-            print("Here are the current plates: {}\n".format(', '.join([p['code'] for p in plates])))
-            code = prompt_for('Enter the code of the plate you want to edit')
-
-        index = plate_codes.index(code)
-        p = plates[index]
+        matches = index.resolve(code)
+        while len(matches) != 1:
+            if len(matches) > 1:
+                print(f'That could be any of these plates: {", ".join(matches)}. Try again.\n')
+            else:
+                print("There's no plate under that code. Try again.")
+                print("Here are the current plates: {}\n".format(', '.join(index.codes)))
+            code = prompt_for('Enter the code of the plate you want to {}'.format(verb))
+            matches = index.resolve(code)
+        return matches[0]
+
+    def view(self,code=None):
+        code = self.prompt_for_code(code, 'view')
+
+        from pprint import pprint
+        p = self._store.load_plate(code)
         pprint(p)
 
     def add(self,code=None):
-        plates = self.load()
         d = {'code': code}
         if code is None:
             d['code'] = str(prompt_for('Code'))
-        if d['code'] in [p['code'] for p in plates]:
+        if d['code'] in self.code_index():
             print("There's already a plate under that code. Try \n     > spin edit {}".format(d['code']))
             return
 
@@ -386,33 +1031,24 @@ class Plates(object):
             d['last_spun'] = None
             d['spin_history'] = []
         elif last_spun == '':
-            d['last_spun'] = datetime.strftime(datetime.now(),"%Y-%m-%dT%H:%M:%S.%f")
-            d['spin_history'] = [datetime.strftime(datetime.now(),"%Y-%m-%d")]
+            d['last_spun'] = format_last_spun(datetime.now())
+            d['spin_history'] = [format_day(datetime.now())]
         else:
-            d['last_spun'] = datetime.strftime(datetime.strptime(last_spun,"%Y-%m-%d"), "%Y-%m-%dT%H:%M:%S.%f")
-            d['spin_history'] = [datetime.strftime(datetime.strptime(last_spun,"%Y-%m-%d"), "%Y-%m-%d")]
+            d['last_spun'] = format_last_spun(parse_day(last_spun))
+            d['spin_history'] = [format_day(parse_date(last_spun))]
             # The above line seems like it does something and then undoes it, but really it's 
             # validating that the entered date is in the right format.
 
-        plates.append(d)
-        self.store(plates)
+        self._store.store_plate(d) # A new code gets added at the end.
         print('"{}" was added to the plates being tracked.'.format(d['description']))
         self.check()
 
     def edit(self,code=None):
-        plates = self.load()
-        if code is None:
-            print("You have to specify the code of an existing plate to edit.")
-            print("Here are the current plates: {}\n".format(', '.join([p['code'] for p in plates])))
-            code = prompt_for('Enter the code')
-        plate_codes = [p['code'] for p in plates]
-        while code not in plate_codes:
-            print("There's no plate under that code. Try again.")
-            print("Here are the current plates: {}\n".format(', '.join([p['code'] for p in plates])))
-            code = prompt_for('Enter the code of the plate you want to edit')
-
-        index = plate_codes.index(code)
-        p = plates[index]
+        code = self.prompt_for_code(code, 'edit')
+
+        version = self._store.version()
+        p = self._store.load_plate(code)
+        original = dict(p)
         p['description'] = prompt_to_edit_field(p,'Description','description')
         p['period_in_days'] = float(prompt_to_edit_field(p,'Period in days','period_in_days'))
 
@@ -423,112 +1059,82 @@ class Plates(object):
             if last_spun == 'None':
                 p['last_spun'] = None
             elif last_spun == 'now':
-                p['last_spun'] = datetime.strftime(datetime.now(),"%Y-%m-%dT%H:%M:%S.%f")
+                p['last_spun'] = format_last_spun(datetime.now())
             else:
-                p['last_spun'] = datetime.strftime(datetime.strptime(last_spun,"%Y-%m-%d"), "%Y-%m-%dT%H:%M:%S.%f")
-        # plates has now been updated since p points to the corresponding element in plates.
-
-        # [ ] What about editing the spin history?
-        self.store(plates)
+                p['last_spun'] = format_last_spun(parse_day(last_spun))
+
+        # (The spin history has its own commands: spin history edit/remove.)
+
+        # Other spin processes may have changed the rack while the prompts
+        # were waiting, so rather than overwriting their changes, merge the
+        # fields edited here into the current version of the plate.
+        edited = {field: p[field] for field in EDITABLE_FIELDS if p[field] != original[field]}
+        while True:
+            try:
+                self._store.store_plate(p, expected_version=version)
+                break
+            except StaleRackError:
+                version = self._store.version()
+                current = self._store.load_plate(code)
+                conflicts = [field for field in edited if current[field] not in [original[field], edited[field]]]
+                if len(conflicts) > 0:
+                    for field in conflicts:
+                        print("While you were editing, {} was changed to {}.".format(field, current[field]))
+                    print("Try again.")
+                    return self.edit(code)
+                p = current
+                p.update(edited)
         print('"{}" has been edited.'.format(p['description']))
         self.check()
 
+    def resolve_code(self, code):
+        """Resolve code as either a plate's code or the start of just one
+        plate's code. Returns None (after saying why) if it's neither."""
+        matches = self.code_index().resolve(code)
+        if len(matches) > 1:
+            print(f'Try again with a code that disambiguates the following options: {", ".join(matches)}')
+            return None
+        if len(matches) == 0:
+            print("There's no plate under that code. Try \n     > spin add {}".format(code))
+            return None
+        return matches[0]
+
     def spin(self,code=None,days_ago=None):
-        plates = self.load()
         if code is None:
             code = prompt_for('Code')
-        plate_codes = [p['code'] for p in plates]
-        if code not in plate_codes:
-            # Try matching by partial substring
-            partial_matches = [c for c in plate_codes if re.match(str(code),c) is not None]
-            if len(partial_matches) == 1:
-                code = partial_matches[0]
-                print("Spinning {}.".format(code))
-            elif len(partial_matches) > 1:
-                print(f'Try again with a code that disambiguates the following options: {", ".join(partial_matches)}')
-                return
-            else:
-                print("There's no plate under that code. Try \n     > spin add {}".format(code))
-                return
-        else:
-            print("Spinning {}.".format(code))
+        code = self.resolve_code(code)
+        if code is None:
+            return
+        print("Spinning {}.".format(code))
 
-        # Find the corresponding plate to spin.
-        index = plate_codes.index(code)
-        p = plates[index]
-        
         if days_ago is None:
             dt_spun = datetime.now()
         else:
             dt_spun = datetime.now() - timedelta(days=int(days_ago))
 
-        date_spun = datetime.strftime(dt_spun,"%Y-%m-%d")
-
-        if 'spin_history' in p:
-            # Load spin history from file.
-            if p['spin_history'] is None:
-                spin_history = []
-            else:
-                spin_history = p['spin_history']
-            if spin_history == [] and p['last_spun'] is not None:
-                last_spun_dt = datetime.strptime(p['last_spun'], "%Y-%m-%dT%H:%M:%S.%f")
-                last_spun_string = datetime.strftime(last_spun_dt,"%Y-%m-%d")
-                spin_history = [last_spun_string,date_spun]
-            else:
-                spin_history.append(date_spun)
-            p['spin_history'] = spin_history
-        elif p['last_spun'] is not None:
-            last_spun_dt = datetime.strptime(p['last_spun'], "%Y-%m-%dT%H:%M:%S.%f")
-            last_spun_string = datetime.strftime(last_spun_dt,"%Y-%m-%d")
-            spin_history = [last_spun_string,date_spun]
-            p['spin_history'] = spin_history
-        else:
-            p['spin_history'] = [date_spun]
-        p['last_spun'] = datetime.strftime(dt_spun,"%Y-%m-%dT%H:%M:%S.%f")
-
-        self.store(plates)
+        # Rather than rewriting the whole rack, just record the spin.
+        self._store.record_event({'event': 'spin', 'code': code,
+            'spun': format_last_spun(dt_spun)})
 
     def shelve(self,code=None,shelving_mode='Done'):
-        # shelving_mode allows for a plate to be paused, but
-        # this is not being taken into account in its spin stats
-        # calculations yet.
-        plates = self.load()
+        # shelving_mode allows for a plate to be paused. Paused time
+        # is left out of the effective period in stats (see PauseIndex).
         if code is None:
             code = prompt_for('Code')
-        plate_codes = [p['code'] for p in plates]
-        if code not in plate_codes:
-            print("There's no plate under that code. Try \n     > spin add {}".format(code))
+        code = self.resolve_code(code)
+        if code is None:
             return
+        p = self._store.load_plate(code)
 
-        # Find the corresponding plate to spin.
-        index = plate_codes.index(code)
-        p = plates[index]
-
-        today = datetime.strftime(datetime.now(),"%Y-%m-%d")
+        today = format_day(datetime.now())
 
         previous_status = str(p['status']) if 'status' in p else 'Active'
         if shelving_mode == previous_status:
             print('The plate ("{}") is already shelved with status {}.'.format(p['code'],previous_status))
             return
 
-        if shelving_mode == 'Paused':
-            pauses = load_pauses(p)
-            pauses.append([today, None])
-            p['pauses'] = pauses
-        elif shelving_mode == 'Active' and previous_status == 'Paused':
-            pauses = load_pauses(p)
-            if len(pauses) == 0:
-                print("Inferring missing pause history...")
-                pauses = [[p['spin_history'],today]]
-            else:
-                assert pauses[-1][1] == None
-                pauses[-1][1] = today
-            p['pauses'] = pauses
-        #else: # Maybe deal with cases where projects are reawakened (Done ==> Active, Done ==> Paused),
-        # though Done ==> Paused will already be handled by the first if statement above.
-
-        p['status'] = shelving_mode
-        self.store(plates)
+        self._store.record_event({'event': 'shelve', 'code': p['code'],
+            'mode': shelving_mode, 'date': today})
         print('Put the {} plate ("{}") on the shelf with mode {}.'.format(p['code'],p['description'], shelving_mode))
 
     def pause(self,code=None):
@@ -540,95 +1146,203 @@ class Plates(object):
     def done(self,code=None):
         self.shelve(code,shelving_mode='Done')
 
-    def stats(self):
-        unsorted_plates = self.load()
+    def import_spins(self, filepath, format=None):
+        """Add the spins in a CSV file of code,date rows (or a JSON Lines file
+        of {"code": ..., "date": ...} events) to the plates' histories, with one
+        store of the rack for the whole file. Dates are YYYY-MM-DD or ISO
+        times, and spins already in a history are skipped. (Run as "spin
+        import".)
+        > spin import backfill.csv
+        > spin import spins.jsonl"""
+        from formats import EVENT_FORMATS, event_format, read_events
+        from dates import parse_time
+        format = format or event_format(filepath)
+        if format not in EVENT_FORMATS:
+            print("The formats for importing are {}.".format(', '.join(EVENT_FORMATS)))
+            return
+        if not os.path.exists(filepath):
+            print("There's no file at {}.".format(filepath))
+            return
+        spins, problems = {}, []
+        with open(filepath,'r', newline='') as f:
+            for line_number, code, when in read_events(f, format):
+                try:
+                    if code is None:
+                        raise ValueError
+                    spins.setdefault(code, []).append(parse_time(when))
+                except ValueError:
+                    problems.append("Line {}: can't read a code and date there.".format(line_number))
+
+        version = self._store.version()
+        ps = self.load()
+        codes = set(p['code'] for p in ps)
+        problems += ["There's no plate under the code {}.".format(code) for code in spins if code not in codes]
+        if len(problems) > 0: # All or nothing
+            print("Nothing was imported, because of these problems:")
+            for problem in problems[:10]:
+                print("    " + problem)
+            if len(problems) > 10:
+                print("    (and {} more)".format(len(problems) - 10))
+            return
+        while True:
+            added, plates_changed = 0, 0
+            for p in ps:
+                if p['code'] in spins:
+                    n, _ = apply_history(p, spins[p['code']])
+                    added += n
+                    plates_changed += 1 if n > 0 else 0
+            if added == 0: # Nothing new, so there's nothing to store.
+                break
+            try:
+                self._store.store(ps, expected_version=version)
+                break
+            except StaleRackError: # Somebody else changed the rack, so start over from their version.
+                version = self._store.version()
+                ps = self.load()
+        total = sum(len(times) for times in spins.values())
+        print("Imported {} spins into {} plates (skipping {} duplicates).".format(added, plates_changed, total - added))
+
+    def history(self):
+        """Edit spin histories ("spin history edit" and "spin history remove")."""
+        return History(self)
+
+    def stats(self,limit=None,format='table',workers=1):
+        """Show each plate's total spins and effective period (the average
+        time between spins).
+        > spin stats --format csv (or json, jsonl or arrow)
+        > spin stats --workers 4 (splits a big rack across 4 processes)"""
+        from formats import is_format
+        if not is_format(format):
+            return
+        unsorted_plates = self.load_visible()
         template = "{{:<11.11}}  {{:<35.35}} {{:<8}}  {}  {{:<7}} {{:<6}}"
         fmt = template.format("{:>9.9}")
-        print(fmt.format("", "", "Total", "Effective", "Period", ""))
-        print(fmt.format("Code","Description","spins", "period","in days", "Status"))
-        print("=============================================================================")
-        plates = []
-        for p in unsorted_plates:
-            total_spins = 0
-            in_last_n_cycles = 0
-            effective_period = ""
-            fmt = template.format("{:9}")
-            if 'spin_history' in p:
-                if p['spin_history'] is not None:
-                    spin_history = p['spin_history'] # A list of date_strings
-                else:
-                    spin_history = []
-                total_spins = len(spin_history)
-                n = 2
-                span = timedelta(n*p['period_in_days'])
-                in_last_n_cycles = spins_in_span(spin_history,span)
-                if total_spins > 0:
-                    first_datetime = datetime.strptime(spin_history[0],'%Y-%m-%d')
-                    last_datetime = datetime.strptime(spin_history[-1],'%Y-%m-%d')
-                    if total_spins in [0,1]:
-                        effective_period = "None"
+        lines = [fmt.format("", "", "Total", "Effective", "Period", ""),
+            fmt.format("Code","Description","spins", "period","in days", "Status"),
+            "============================================================================="]
+        fmt_text = template.format("{:9}") # Built once, rather than for each plate
+        fmt_number = template.format("{:>9.1f}")
+        if workers > 1:
+            sorted_plates = stats_sharded(unsorted_plates, self.context, workers, limit)
+            for p in sorted_plates:
+                p['fmt'] = fmt_number if p['effective_period'] not in ['', 'None'] else fmt_text
+        else:
+            plates = []
+            for p in unsorted_plates:
+                total_spins = 0
+                in_last_n_cycles = 0
+                effective_period = ""
+                fmt = fmt_text
+                if 'spin_history' in p:
+                    if p['spin_history'] is not None:
+                        spin_history = p['spin_history'] # A list of date_strings
                     else:
-                        #effective_period = (last_datetime-first_datetime).days/(total_spins-1.0)
-                        effective_period = (datetime.now() - first_datetime).days/(total_spins - 1.0)
-                        fmt = template.format("{:>9.1f}")
-                plate = {'status': p.get('status', 'Active'),
-                        'fmt': fmt,
-                        'code': p['code'],
-                        'span': span,
-                        'total_spins': total_spins,
-                        'in_last_n_cycles': in_last_n_cycles,
-                        'description': p['description'],
-                        'period_in_days': p['period_in_days'],
-                        'effective_period': effective_period}
-                plates.append(plate)
-        for p in sorted(plates, key=lambda k: k['effective_period'] if k['effective_period'] not in ['', 'None'] else 99999, reverse=True):
+                        spin_history = []
+                    total_spins = len(spin_history)
+                    n = 2
+                    span = timedelta(n*p['period_in_days'])
+                    in_last_n_cycles = spins_in_last_cycles(p,span,self.context)
+                    if total_spins > 0:
+                        first_datetime = parse_day(spin_history[0])
+                        last_datetime = parse_day(spin_history[-1])
+                        if total_spins in [0,1]:
+                            effective_period = "None"
+                        else:
+                            #effective_period = (last_datetime-first_datetime).days/(total_spins-1.0)
+                            now = self.context.now
+                            paused = PauseIndex(load_pauses(p), now).paused_between(first_datetime, now)
+                            effective_period = (now - first_datetime - paused).days/(total_spins - 1.0) # Time
+                            # spent paused doesn't count against the plate.
+                            fmt = fmt_number
+                    plate = {'status': p.get('status', 'Active'),
+                            'fmt': fmt,
+                            'code': p['code'],
+                            'span': span,
+                            'total_spins': total_spins,
+                            'in_last_n_cycles': in_last_n_cycles,
+                            'description': p['description'],
+                            'period_in_days': p['period_in_days'],
+                            'effective_period': effective_period}
+                    plates.append(plate)
+            sorted_plates = top_rows(plates, key=lambda k: k['effective_period'] if k['effective_period'] not in ['', 'None'] else 99999, limit=limit, reverse=True)
+        if format != 'table':
+            from formats import write_records
+            fields = ['code', 'description', 'total_spins', 'spins_in_last_2_cycles', 'effective_period',
+                'period_in_days', 'status']
+            records = ({'code': p['code'], 'description': p['description'], 'total_spins': p['total_spins'],
+                'spins_in_last_2_cycles': p['in_last_n_cycles'],
+                'effective_period': p['effective_period'] if p['effective_period'] not in ['', 'None'] else None,
+                'period_in_days': p['period_in_days'], 'status': p['status'] or 'Active'} for p in sorted_plates)
+            write_records(records, fields, format)
+            return
+        for p in sorted_plates:
             if 'status' not in p or p['status'] is None:
                 p['status'] = 'Active'
-            print(p['fmt'].format(p['code'], p['description'],
+            lines.append(p['fmt'].format(p['code'], p['description'],
                 "{:<} ({})".format(p['total_spins'], p['in_last_n_cycles']),
                 p['effective_period'],
                 p['period_in_days'],
                 p['status']))
-        print("=============================================================================\n")
+        lines += ["=============================================================================", ""]
+        sys.stdout.write("\n".join(lines) + "\n")
 
     ##### PROJECT-VIEW FUNCTIONS #####
 
-    def projects(self, full=False):
+    def projects(self, full=False, format='table'):
         """Show a project view (rather than a communications-oriented spin view)
         by using a bar chart, the first spin date, the current date, and whether
         the project is still active."""
-        ps = self.load()
+        from formats import is_format
+        if not is_format(format):
+            return
+        ps = self.load_visible()
         ender = {'Active': '>', 'Done': ']', 'Paused': '"'}
         scorer = {'Active': 0, 'Paused': 1, 'Done': 2}
         bars = []
         index = []
         scores = {}
+        records = []
         for k,project in enumerate(ps):
             if 'spin_history' in project and len(project['spin_history']) > 0:
                 start = project['spin_history'][0] # e.g., "2018-02-02"
-                start_dt = datetime.strptime(start, "%Y-%m-%d")
+                start_dt = parse_day(start)
                 if 'status' not in project:
                     status = 'Active'
                 else:
                     status = project['status']
                 if status in ['Active']:
-                    end_dt = datetime.now()
+                    end_dt = self.context.now
                 else:
                     end = project['spin_history'][-1] # e.g., "2018-10-10"
-                    end_dt = datetime.strptime(end, "%Y-%m-%d")
+                    end_dt = parse_day(end)
                 if full and status == 'Paused':
-                    end_dt = datetime.now() # This forces even paused projects to print
+                    end_dt = self.context.now # This forces even paused projects to print
                     # full bar charts.
 
                 # [ ] Once a paused project is unpaused, it will make sense to
                 # exclude the paused weeks from the non-full bar chart.
                 terminator = ender[status]
                 score = scorer[status]
-                bar = form_bar(project,start_dt,end_dt,terminator)
+                if format != 'table':
+                    in_last_n_cycles, duration, d_bar = bar_parts(project,start_dt,end_dt,self.context)
+                    records.append({'code': project['code'], 'status': status,
+                        'start': start_dt.date().isoformat(), 'end': end_dt.date().isoformat(),
+                        'duration_weeks': duration, 'spins_in_last_2_cycles': in_last_n_cycles,
+                        'weeks': d_bar + terminator})
+                    scores[len(records)-1] = score
+                    continue
+                bar = form_bar(project,start_dt,end_dt,terminator,self.context)
                 bars.append(bar)
                 index.append(k)
                 scores[bar] = score
 
+        if format != 'table':
+            from formats import write_records
+            order = sorted(range(len(records)), key=lambda r: scores[r])
+            write_records((records[r] for r in order), ['code', 'status', 'start', 'end',
+                'duration_weeks', 'spins_in_last_2_cycles', 'weeks'], format)
+            return
+
         sorted_bars = sorted(bars,key = lambda b: scores[b])
 
         header = """           spins in
@@ -647,19 +1361,158 @@ code       cycles   duration"""
     def p_watch(self):
         bars, header = self.projects()
         msg = '\n'.join(bars)
+        from notify import send_to_slack
         send_to_slack(msg,username='Captain Projecto',channel='@david',icon=':film_projector:')
 
     ##### END PROJECT-VIEW FUNCTIONS #####
 
+def date_list(dates):
+    # fire turns "2024-03-01,2024-03-08" into a string and repeated values
+    # (or several arguments) into a tuple.
+    if isinstance(dates, str):
+        dates = dates.split(',')
+    return [str(d).strip() for d in dates if str(d).strip() != '']
+
+class History(object):
+    """The commands for editing a plate's spin history. Each one reads the
+    plate once, merges the changes into the history in one pass (see
+    storage.apply_history) and stores it once."""
+
+    def __init__(self, plates):
+        self._plates = plates
+
+    def change(self, code, added=(), removed=()):
+        store = self._plates._store
+        version = store.version()
+        while True:
+            p = store.load_plate(code)
+            counts = apply_history(p, added, removed)
+            try:
+                store.store_plate(p, expected_version=version)
+                return p, counts
+            except StaleRackError:
+                version = store.version()
+
+    def edit(self, code=None, add=None, remove=None):
+        """Add spins to and remove spins from a plate's history (prompting for
+        them if neither --add nor --remove is given).
+        > spin history edit trash --add 2024-03-01,2024-03-08 --remove 2024-03-02"""
+        from dates import parse_time
+        if add is None and remove is None:
+            code = self._plates.prompt_for_code(code, 'edit the history of')
+            history = self._plates._store.load_plate(code).get('spin_history') or []
+            print("The last spins of {}: {}".format(code, ', '.join(history[-10:]) or 'none'))
+            add = prompt_for("Spins to add [YYYY-MM-DD, ...]")
+            remove = prompt_for("Spins to remove [YYYY-MM-DD, ...]")
+        else:
+            code = self._plates.resolve_code(code if code is not None else prompt_for('Code'))
+            if code is None:
+                return
+        try:
+            added = [parse_time(d) for d in date_list(add or [])]
+            removed = [parse_date(d) for d in date_list(remove or [])]
+        except ValueError:
+            print("Spins take dates in the form YYYY-MM-DD (or ISO times, for adding).")
+            return
+        p, (n_added, n_removed) = self.change(code, added, removed)
+        print("Added {} and removed {} spins of {}, which now has {} spins (last spun {}).".format(
+            n_added, n_removed, code, len(p['spin_history']), p['last_spun']))
+
+    def remove(self, code=None, *dates):
+        """Remove spins from a plate's history.
+        > spin history remove trash 2024-03-02 2024-03-09"""
+        self.edit(code, remove=list(dates) if len(dates) > 0 else prompt_for("Spins to remove [YYYY-MM-DD, ...]"))
+
+def peel_option(argv, option, takes_value):
+    """Find a global option anywhere in argv and return its value (or None if
+    it's not there) and the rest of argv. An option that takes a value can be
+    given as "--option value" or "--option=value". One that doesn't is True
+    when given as "--option", though "--option=value" still sets a value."""
+    for k, arg in enumerate(argv):
+        if arg == option:
+            if not takes_value:
+                return True, argv[:k] + argv[k+1:]
+            return (argv[k+1] if k+1 < len(argv) else ''), argv[:k] + argv[k+2:]
+        if arg.startswith(option + '='):
+            return arg.split('=', 1)[1], argv[:k] + argv[k+1:]
+    return None, argv
+
+# The functions and methods that --profile times (see profiling.py)
+TRACED = ['Plates.load', 'Plates.store', 'Plates.check', 'Plates.stats', 'Plates.total', 'aggregate:count_spins',
+    'Plates.projects', 'Plates.spin', 'inspect', 'inspect_rack', 'pack_histories',
+    'rack_lateness', 'Plates.load_plates', 'check_all_racks', 'print_table', 'plate:parse_history',
+    'form_bar', 'PauseIndex.__init__']
+
+def main(argv, plates_for=Plates):
+    if argv == ['serve']: # Keep the racks in memory and answer commands over a socket.
+        import daemon
+        daemon.serve(sys.modules[__name__])
+        return
+
+    # "--as-of YYYY-MM-DD" evaluates the rack as of the end of that day.
+    as_of, argv = peel_option(argv, '--as-of', takes_value=True)
+    if as_of is not None:
+        try:
+            as_of = parse_date(as_of)
+        except ValueError:
+            print("--as-of takes a date in the form YYYY-MM-DD.")
+            return
+
+    # "--profile" (or "--profile=check.trace" or "--profile=check.prof") times
+    # the command. See profiling.py.
+    profile, argv = peel_option(argv, '--profile', takes_value=False)
+    enabled = False
+    if profile is not None or 'SPIN_TRACE' in os.environ:
+        import profiling
+        enabled, output = profiling.requested(profile)
+    if enabled:
+        profiling.start(sys.modules[__name__], TRACED, output)
+        try:
+            run(argv, as_of, plates_for)
+        finally:
+            profiling.stop()
+    else:
+        run(argv, as_of, plates_for)
+
+def run(argv, as_of, plates_for):
+    try:
+        dispatch(argv, as_of, plates_for)
+    except JournalError as e: # Rather than lose the spins in the journal
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+def dispatch(argv, as_of, plates_for):
+    plates_file = PLATES_FILE
+    if len(argv) > 0 and argv[0] in find_all_racks(): # If the first argument designates
+        plates_file = rack_file(argv[0]) # one of the plates files, peel it off and
+        argv = argv[1:] # use it to override the default plates file.
+    if len(argv) > 0 and argv[0] == 'import': # (A keyword, so it can't be
+        argv = ['import_spins'] + argv[1:] # the name of the method.)
+    plates = plates_for(plates_file)
+    plates.context = EvalContext(as_of) # One frozen clock for the whole command
+
+    # The most common commands skip fire (both importing it and its
+    # introspection of Plates).
+    if len(argv) == 0 or argv == ['check']:
+        plates.check() # Make this the default.
+    elif argv == ['all']:
+        plates.all()
+    elif len(argv) == 2 and argv[0] == 'spin' and not argv[1].startswith('-'):
+        plates.spin(argv[1])
+    elif len(argv) == 1 and not argv[0].startswith('-') and not hasattr(Plates, argv[0]):
+        plates.spin(argv[0]) # "spin trash" spins the trash plate.
+    else:
+        import fire
+        fire.Fire(plates, command=argv)
+
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        Plates().check() # Make this the default.
+    argv = sys.argv[1:]
+    # Hand the command to "spin serve" if it's running (unless SPIN_TRACE asks
+    # to profile this process). Without a daemon, forward() returns before
+    # importing socket.
+    if argv == ['serve'] or os.environ.get('SPIN_TRACE', '') not in ['', '0']:
+        main(argv)
     else:
-        all_racks = find_all_racks()
-        arg1 = sys.argv[1]
-        if arg1 in all_racks: # If the first argument designates 
-            plates_file = "{}.json".format(arg1) # one of the plates
-            del(sys.argv[1]) # peel it off, and use it to override the
-            fire.Fire(Plates(plates_file=plates_file)) # default plates file.
-        else:
-            fire.Fire(Plates())
+        from daemon import forward
+        if not forward(argv, PATH):
+            main(argv)
@@ -0,0 +1,494 @@
+import os, sys, fcntl
+from heapq import merge
+from dates import parse_date, parse_day, parse_last_spun, format_day, format_last_spun, is_iso_date
+from rollup import build_rollup, with_spin, current_rollup
+from collections import defaultdict
+from contextlib import contextmanager
+from json import loads, dumps
+
+# A rack of plates can be kept either in a JSON file (the original format) or
+# in an SQLite database, depending on the extension of the rack file. Both
+# backends answer the same calls, so Plates doesn't need to know which one it
+# is talking to:
+#   load()                 all the plates in the rack
+#   codes()                just the plate codes
+#   load_plate(code)       a single plate (or None)
+#   store(plates)          replace the whole rack
+#   store_plate(plate)     replace (or add) one plate
+#   record_event(event)    apply a spin or shelving to one plate
+#   compact()              fold any pending journal into the rack
+#   version()              a counter that goes up with every change to the rack
+# Every read-modify-write happens under an exclusive fcntl lock on a lock file
+# next to the rack (reads take a shared lock), so several spin processes can
+# safely work on the same rack. A store can also be given the version of the
+# rack that the caller last saw, in which case it fails with StaleRackError
+# if anybody else has changed the rack since then.
+
+SQLITE_EXTENSIONS = ['.sqlite', '.db']
+
+def open_store(filepath):
+    if os.path.splitext(filepath)[1] in SQLITE_EXTENSIONS:
+        return SqliteStore(filepath)
+    return JsonStore(filepath)
+
+def load_pauses(p):
+    if 'pauses' in p:
+        pauses = p['pauses'] # A list of 2-element lists, with the first element being the
+        # beginning of the pause and the second being the end of the pause (equal to None) if
+        # the pause is ongoing.
+    else:
+        pauses = []
+    return pauses
+
+def apply_spin(p, dt_spun):
+    date_spun = format_day(dt_spun)
+    rollup = current_rollup(p)
+
+    if 'spin_history' in p:
+        # Load spin history from file.
+        if p['spin_history'] is None:
+            spin_history = []
+        else:
+            spin_history = p['spin_history']
+        if spin_history == [] and p['last_spun'] is not None:
+            last_spun_string = format_day(parse_last_spun(p['last_spun']))
+            spin_history = [last_spun_string,date_spun]
+        else:
+            spin_history.append(date_spun)
+        p['spin_history'] = spin_history
+    elif p['last_spun'] is not None:
+        last_spun_string = format_day(parse_last_spun(p['last_spun']))
+        spin_history = [last_spun_string,date_spun]
+        p['spin_history'] = spin_history
+    else:
+        p['spin_history'] = [date_spun]
+    p['last_spun'] = format_last_spun(dt_spun)
+    # Keep the plate's rollup (see rollup.py) up to date, building it from
+    # the history if there wasn't a good one to add this spin to.
+    if (rollup is not None and rollup['count'] + 1 == len(p['spin_history'])
+            and rollup['period'] == p['period_in_days']):
+        p['rollup'] = with_spin(rollup, date_spun)
+    else:
+        p['rollup'] = build_rollup(p['spin_history'], p['period_in_days'])
+
+def apply_history(p, added=(), removed=()):
+    """Merge the spins in added (datetimes) into p's spin history and take
+    the days in removed (dates) out of it, in one pass, leaving the history
+    sorted and last_spun and the rollup to match. A day that is already in
+    the history isn't added again, but the history's own entries are all
+    kept (a plate can be spun twice in a day), and removing a day takes out
+    every spin on it. Returns the number of spins added and the number
+    removed."""
+    history = p.get('spin_history') or []
+    if len(history) == 0 and p.get('last_spun') is not None: # As in apply_spin()
+        history = [format_day(parse_last_spun(p['last_spun']))]
+    if not all(is_iso_date(d) for d in history):
+        history = [format_day(parse_date(d)) for d in history]
+    if not all(a <= b for a, b in zip(history, history[1:])): # Only hand-edited
+        history = sorted(history) # histories should need this.
+    removed = set(format_day(d) for d in removed)
+    before = set(history)
+    new = sorted(set(format_day(dt) for dt in added if format_day(dt) not in removed) - before)
+    merged = [d for d in merge(history, new) if d not in removed]
+    spins_added = len(new)
+    spins_removed = len(history) + spins_added - len(merged)
+    # last_spun is the latest of the spins that are left (keeping the time
+    # of day where there is one).
+    times = [dt for dt in added if format_day(dt) not in removed]
+    if p.get('last_spun') is not None and format_day(parse_last_spun(p['last_spun'])) not in removed:
+        times.append(parse_last_spun(p['last_spun']))
+    if len(merged) > 0:
+        times.append(parse_day(merged[-1]))
+    p['spin_history'] = merged
+    p['last_spun'] = format_last_spun(max(times)) if len(times) > 0 else None
+    p['rollup'] = build_rollup(merged, p['period_in_days'])
+    return spins_added, spins_removed
+
+def apply_shelve(p, shelving_mode, today):
+    previous_status = str(p['status']) if 'status' in p else 'Active'
+    if shelving_mode == 'Paused':
+        pauses = load_pauses(p)
+        pauses.append([today, None])
+        p['pauses'] = pauses
+    elif shelving_mode == 'Active' and previous_status == 'Paused':
+        pauses = load_pauses(p)
+        if len(pauses) == 0:
+            print("Inferring missing pause history...")
+            pauses = [[p['spin_history'],today]]
+        else:
+            assert pauses[-1][1] == None
+            pauses[-1][1] = today
+        p['pauses'] = pauses
+    #else: # Maybe deal with cases where projects are reawakened (Done ==> Active, Done ==> Paused),
+    # though Done ==> Paused will already be handled by the first if statement above.
+
+    p['status'] = shelving_mode
+
+def apply_event(p, event):
+    if event['event'] == 'spin':
+        apply_spin(p, parse_last_spun(event['spun']))
+    elif event['event'] == 'shelve':
+        apply_shelve(p, event['mode'], event['date'])
+
+def apply_journal_event(p, event):
+    """Apply an event from a rack's journal, noting its id in the plate (see
+    replay_journal())."""
+    apply_event(p, event)
+    if 'id' in event:
+        p['journal_id'] = event['id']
+
+def replace_plate(plates, plate):
+    """Put plate in place of the plate with the same code (in one pass over
+    the rack), or at the end if it's new."""
+    for k, p in enumerate(plates):
+        if p['code'] == plate['code']:
+            plates[k] = plate
+            return
+    plates.append(plate)
+
+class StaleRackError(Exception):
+    """Raised by a store that expected an older version of the rack than the
+    current one."""
+    pass
+
+class JournalError(Exception):
+    """Raised when a JSON rack's journal holds events that can't be applied
+    to the rack file (rather than dropping them)."""
+    pass
+
+@contextmanager
+def locked(filepath, exclusive=True):
+    """Hold an advisory lock on <rack>.lock. The lock file also serves as a
+    place to keep the version counter of a JSON rack (whose own format is
+    just a list of plates)."""
+    with open(filepath + ".lock",'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def check_version(current, expected):
+    if expected is not None and expected != current:
+        raise StaleRackError("The rack has changed (version {} is now {}).".format(expected, current))
+
+##### JSON RACKS #####
+# Spins and shelvings are appended to a journal file (one JSON event per line)
+# next to the rack file rather than rewriting the whole rack. Loading the rack
+# replays the journal onto the snapshot in the rack file, and any full store
+# (or "spin compact") folds the journal back into the snapshot. Each event
+# has a random id, and a plate keeps the id of the last event folded into it
+# (as its "journal_id"), so if a store is interrupted between replacing the
+# rack file and removing the journal, the events already in the snapshot are
+# not replayed again. This holds up through hand edits of the rack file.
+
+def snapshot_key(filepath):
+    """Identify the current version of the rack file (for the codes sidecar,
+    and for journal events written before events had ids)."""
+    try:
+        s = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return "{}:{}:{}".format(s.st_ino, s.st_mtime_ns, s.st_size)
+
+def read_journal(journal_filepath):
+    events = []
+    if os.path.exists(journal_filepath):
+        with open(journal_filepath,'r') as f:
+            for line in f:
+                try:
+                    events.append(loads(line))
+                except ValueError: # A torn last line from an interrupted append
+                    pass
+    return events
+
+def replay_journal(plates, events, base, journal_filepath):
+    """Apply the journal's events to the plates of the snapshot and return the
+    number applied. A plate's events up through its journal_id are already
+    in the snapshot. Raises JournalError if there are events that can't be
+    applied, since skipping them would lose spins."""
+    by_code = {p['code']: p for p in plates}
+    events_by_code = defaultdict(list)
+    for event in events:
+        events_by_code[event['code']].append(event)
+    applied, problems = 0, []
+    for code, plate_events in events_by_code.items():
+        p = by_code.get(code)
+        if p is None:
+            problems.append("{} journal entr{} for {}, which is not in the rack".format(len(plate_events),
+                "y" if len(plate_events) == 1 else "ies", code))
+            continue
+        ids = [event.get('id') for event in plate_events]
+        last = p.get('journal_id')
+        start = ids.index(last) + 1 if last is not None and last in ids else 0
+        for event in plate_events[start:]:
+            if 'id' not in event and event.get('base') != base: # From before
+                # events had ids, and the rack file has changed since.
+                problems.append("a journal entry for {} written against an older version of the rack file".format(code))
+                continue
+            apply_journal_event(p, event)
+            applied += 1
+    if len(problems) > 0:
+        raise JournalError("The journal {} can't be applied to the rack: {}. Fix the rack file (or take those "
+            "entries out of the journal, one per line) and try again.".format(journal_filepath, '; '.join(problems)))
+    return applied
+
+class JsonStore(object):
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._journal_filepath = filepath + ".journal" # Not ending in .json
+        # keeps find_all_racks() from mistaking it for a rack.
+        self._codes_filepath = filepath + ".codes"
+
+    # read, write and the *_version methods expect the caller to hold the lock.
+
+    def read(self):
+        return self.read_counting()[0]
+
+    def read_counting(self):
+        """Read the rack, returning its plates and the number of journal events
+        replayed onto them."""
+        if os.path.exists(self._filepath):
+            with open(self._filepath,'r') as f:
+                plates = loads(f.read())
+        else:
+            plates = []
+        events = read_journal(self._journal_filepath)
+        applied = replay_journal(plates, events, snapshot_key(self._filepath), self._journal_filepath)
+        return plates, applied
+
+    def write(self, plates):
+        # Write to a temporary file and rename it over the rack file so that
+        # a crash can never leave a half-written rack behind.
+        tmp_filepath = self._filepath + ".tmp"
+        with open(tmp_filepath,'w') as f:
+            f.write(dumps(plates, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, self._filepath)
+        if os.path.exists(self._journal_filepath): # Its events are part of
+            os.remove(self._journal_filepath) # the new snapshot now.
+        self.write_codes([p['code'] for p in plates])
+
+    # The plate codes are kept in a sidecar file as well, tagged with the
+    # snapshot they came from, so that resolving the code of a plate to spin
+    # doesn't take parsing the whole rack. (The journal only ever holds spins
+    # and shelvings, which don't change the codes.)
+
+    def read_codes(self):
+        try:
+            with open(self._codes_filepath,'r') as f:
+                sidecar = loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(sidecar, dict) or sidecar.get('snapshot') != snapshot_key(self._filepath):
+            return None # The rack file has changed since (by hand, say).
+        return sidecar['codes']
+
+    def write_codes(self, codes):
+        tmp_filepath = self._codes_filepath + ".tmp"
+        try:
+            with open(tmp_filepath,'w') as f:
+                f.write(dumps({'snapshot': snapshot_key(self._filepath), 'codes': codes}))
+            os.replace(tmp_filepath, self._codes_filepath)
+        except OSError: # It's rebuilt whenever it's missing.
+            pass
+
+    def read_version(self, lock_file):
+        lock_file.seek(0)
+        text = lock_file.read().strip()
+        return int(text) if text else 0
+
+    def bump_version(self, lock_file):
+        version = self.read_version(lock_file) + 1
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(version))
+        lock_file.flush()
+
+    def load(self):
+        with locked(self._filepath, exclusive=False):
+            return self.read()
+
+    def version(self):
+        with locked(self._filepath, exclusive=False) as lock_file:
+            return self.read_version(lock_file)
+
+    def codes(self):
+        with locked(self._filepath, exclusive=False):
+            codes = self.read_codes()
+        if codes is None:
+            with locked(self._filepath):
+                codes = self.read_codes()
+                if codes is None:
+                    plates = []
+                    if os.path.exists(self._filepath):
+                        with open(self._filepath,'r') as f:
+                            plates = loads(f.read())
+                    codes = [p['code'] for p in plates]
+                    self.write_codes(codes)
+        return codes
+
+    def load_plate(self, code):
+        # A JSON rack has to be parsed in full to find any one plate.
+        for p in self.load():
+            if p['code'] == code:
+                return p
+        return None
+
+    def store(self, plates, expected_version=None):
+        with locked(self._filepath) as lock_file:
+            check_version(self.read_version(lock_file), expected_version)
+            self.write(plates)
+            self.bump_version(lock_file)
+
+    def store_plate(self, plate, expected_version=None):
+        with locked(self._filepath) as lock_file:
+            check_version(self.read_version(lock_file), expected_version)
+            plates = self.read()
+            replace_plate(plates, plate)
+            self.write(plates)
+            self.bump_version(lock_file)
+
+    def record_event(self, event):
+        with locked(self._filepath) as lock_file:
+            event['id'] = os.urandom(8).hex()
+            with open(self._journal_filepath,'a') as f:
+                f.write(dumps(event) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.bump_version(lock_file)
+
+    def compact(self):
+        # Compacting doesn't change any plate, so it leaves the version alone.
+        # It returns the number of events folded in (which leaves out any
+        # that were already in the snapshot).
+        with locked(self._filepath):
+            if not os.path.exists(self._journal_filepath):
+                return 0
+            plates, applied = self.read_counting()
+            self.write(plates)
+        return applied
+
+##### SQLITE RACKS #####
+# Each plate is a row of JSON in the plates table, except for its spin
+# history, which goes in the spins table (one row per spin, indexed by code
+# and date). Commands that only touch one plate read and write only that
+# plate's rows.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plates (position INTEGER NOT NULL, code TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS spins (code TEXT NOT NULL, seq INTEGER NOT NULL, date TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS spins_by_code_and_date ON spins (code, date);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+HISTORY_MARKER = True # Stands in for the spin history in the plates table, so
+# that the fields of a plate keep their order (and None and missing histories
+# stay distinguishable) when the plate is put back together.
+
+class SqliteStore(object):
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._connection = None
+
+    def connect(self):
+        if self._connection is None:
+            import sqlite3 # Only SQLite racks pay for importing it.
+            self._connection = sqlite3.connect(self._filepath, timeout=30)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def assemble(self, data, spin_history):
+        p = loads(data)
+        if p.get('spin_history') is HISTORY_MARKER:
+            p['spin_history'] = spin_history
+        return p
+
+    # read_plate and the *_version methods expect the caller to hold the lock.
+
+    def read_plate(self, code):
+        db = self.connect()
+        row = db.execute("SELECT data FROM plates WHERE code = ?", (code,)).fetchone()
+        if row is None:
+            return None
+        spin_history = [date for (date,) in db.execute("SELECT date FROM spins WHERE code = ? ORDER BY seq", (code,))]
+        return self.assemble(row[0], spin_history)
+
+    def read_version(self):
+        return self.connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def bump_version(self, db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def load(self):
+        with locked(self._filepath, exclusive=False):
+            db = self.connect()
+            histories = defaultdict(list)
+            for code, date in db.execute("SELECT code, date FROM spins ORDER BY code, seq"):
+                histories[code].append(date)
+            return [self.assemble(data, histories[code])
+                    for code, data in db.execute("SELECT code, data FROM plates ORDER BY position")]
+
+    def version(self):
+        with locked(self._filepath, exclusive=False):
+            return self.read_version()
+
+    def codes(self):
+        with locked(self._filepath, exclusive=False):
+            return [code for (code,) in self.connect().execute("SELECT code FROM plates ORDER BY position")]
+
+    def load_plate(self, code):
+        with locked(self._filepath, exclusive=False):
+            return self.read_plate(code)
+
+    def write_plate(self, db, plate, position):
+        data = dict(plate)
+        spins = []
+        if isinstance(data.get('spin_history'), list):
+            spins = [(plate['code'], seq, date) for seq, date in enumerate(data['spin_history'])]
+            data['spin_history'] = HISTORY_MARKER
+        db.execute("INSERT OR REPLACE INTO plates (position, code, data) VALUES (?, ?, ?)",
+            (position, plate['code'], dumps(data)))
+        db.execute("DELETE FROM spins WHERE code = ?", (plate['code'],))
+        db.executemany("INSERT INTO spins (code, seq, date) VALUES (?, ?, ?)", spins)
+
+    def write_plate_in_place(self, db, plate):
+        row = db.execute("SELECT position FROM plates WHERE code = ?", (plate['code'],)).fetchone()
+        if row is None:
+            row = db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM plates").fetchone()
+        self.write_plate(db, plate, row[0])
+
+    def store(self, plates, expected_version=None):
+        with locked(self._filepath):
+            check_version(self.read_version(), expected_version)
+            db = self.connect()
+            with db: # One transaction for the whole rack
+                db.execute("DELETE FROM plates")
+                db.execute("DELETE FROM spins")
+                for position, plate in enumerate(plates):
+                    self.write_plate(db, plate, position)
+                self.bump_version(db)
+
+    def store_plate(self, plate, expected_version=None):
+        with locked(self._filepath):
+            check_version(self.read_version(), expected_version)
+            db = self.connect()
+            with db:
+                self.write_plate_in_place(db, plate)
+                self.bump_version(db)
+
+    def record_event(self, event):
+        # The database already gives cheap single-plate writes, so there's no
+        # need for a journal.
+        with locked(self._filepath):
+            p = self.read_plate(event['code'])
+            apply_event(p, event)
+            db = self.connect()
+            with db:
+                self.write_plate_in_place(db, p)
+                self.bump_version(db)
+
+    def compact(self):
+        return 0
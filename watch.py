@@ -0,0 +1,122 @@
+import sys, time, shutil
+from datetime import datetime
+
+# "spin watch" keeps check's table of wobbly plates on the screen (say, on a
+# wall display) and keeps it current. Every few seconds it looks at the rack
+# file, its journal and the store's version (as the daemon does), and when
+# any of them has changed, it reloads the rack. Only the plates whose dicts
+# differ from the previous load are converted to Plate records again and
+# have their metrics recomputed. Lateness, which changes by the minute, is
+# recomputed on every tick (it's cheap), as are the metrics of plates with
+# fractional periods (see plate.is_cacheable). Everything else is recomputed
+# at midnight. On a terminal, only the lines of the screen that changed are
+# rewritten, so the display doesn't flicker.
+
+class RackState(object):
+    """A rack's plates as of the last load, along with their metrics."""
+
+    def __init__(self, spin):
+        self.spin = spin # (Passed in, since spin is usually running as __main__.)
+        self.entries = {} # code -> (plate dict, Plate, metric values or None)
+        self.day = None
+        self.plates = []
+        self.metrics = None
+
+    def update(self, ps, now):
+        """Bring the state up to date with ps (the rack's plate dicts) as of
+        now. Returns the number of plates that had to be converted."""
+        from plate import METRICS, RackMetrics, is_cacheable
+        spin = self.spin
+        if now.date() != self.day: # The metrics depend on the date.
+            self.day = now.date()
+            self.entries = {code: (d, plate, None) for code, (d, plate, values) in self.entries.items()}
+        entries, plates, converted = {}, [], 0
+        metrics = RackMetrics(len(ps))
+        dirty = []
+        for i, p in enumerate(ps):
+            entry = self.entries.get(p['code'])
+            if entry is None or entry[0] != p:
+                entry = (p, spin.Plate.from_dict(p), None)
+                converted += 1
+            d, plate, values = entry
+            if values is None or not is_cacheable(plate):
+                dirty.append(i)
+            else:
+                for field, value in zip(METRICS, values):
+                    getattr(metrics, field)[i] = value
+            entries[p['code']] = entry
+            plates.append(plate)
+        if len(dirty) > 0:
+            metrics.assign(dirty, spin.inspect_rack([plates[i] for i in dirty], now))
+        for i in dirty:
+            d, plate, values = entries[plates[i].code]
+            entries[plates[i].code] = (d, plate, tuple(getattr(metrics, field)[i] for field in METRICS))
+        self.entries, self.plates, self.metrics = entries, plates, metrics
+        return converted
+
+    def frame(self, now, limit, title):
+        """The lines of the screen: a status line, the table and the coda."""
+        spin = self.spin
+        cycles_late = spin.rack_lateness(self.plates, now)
+        wobbly_plates = [spin.Wobbler(plate, self.metrics, i, lateness)
+            for i, (plate, lateness) in enumerate(zip(self.plates, cycles_late)) if lateness is not None]
+        shown = spin.top_rows(wobbly_plates, key=lambda w: -w.cycles_late, limit=limit)
+        coda = "Out of {} plates, {} need{} to be spun.".format(len(self.plates), len(wobbly_plates),
+            "s" if len(wobbly_plates) == 1 else "")
+        more = len(wobbly_plates) - len(shown)
+        return (["{}    (updated {:%Y-%m-%d %H:%M:%S})".format(title, now), ""]
+            + spin.table_lines(shown) + [coda + (" ({} more not shown)".format(more) if more > 0 else "")])
+
+class Screen(object):
+    """Draws frames (lists of lines), rewriting only the lines that changed
+    since the last frame. When the output isn't a terminal, each frame that
+    differs (past its status line) from the last one is written out in full."""
+
+    def __init__(self, out):
+        self.out = out
+        self.tty = out.isatty()
+        self.lines = None
+
+    def draw(self, lines):
+        if not self.tty:
+            if self.lines is None or lines[1:] != self.lines[1:]:
+                self.out.write("\n".join(lines) + "\n\n")
+                self.out.flush()
+            self.lines = lines
+            return
+        parts = ["\x1b[2J"] if self.lines is None else []
+        previous = self.lines or []
+        for k, line in enumerate(lines):
+            if k >= len(previous) or previous[k] != line:
+                parts.append("\x1b[{};1H{}\x1b[K".format(k + 1, line)) # Move to line k and overwrite it.
+        if len(lines) < len(previous):
+            parts.append("\x1b[{};1H\x1b[J".format(len(lines) + 1)) # Clear what's left below.
+        parts.append("\x1b[{};1H".format(len(lines) + 1)) # Park the cursor under the frame.
+        self.out.write(''.join(parts))
+        self.out.flush()
+        self.lines = lines
+
+def watch(spin, plates, interval=2.0, limit=None):
+    from daemon import file_signature
+    filepath = str(plates)
+    def signature():
+        return (file_signature(filepath), file_signature(filepath + '.journal'), plates._store.version())
+
+    screen = Screen(sys.stdout)
+    if limit is None and screen.tty: # As many rows as fit on the screen
+        limit = max(1, shutil.get_terminal_size().lines - 8)
+    state = RackState(spin)
+    seen, ps = None, None
+    try:
+        while True:
+            now = plates.context.now if plates.context.is_historical() else datetime.now()
+            current = signature() # Taken before loading, so that a change
+            # that lands during the load just means another load next time.
+            if current != seen:
+                ps = plates.load_visible()
+                seen = current
+            state.update(ps, now)
+            screen.draw(state.frame(now, limit, filepath))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass